@@ -0,0 +1,101 @@
+import time
+import asyncio
+import logging
+
+
+logger = logging.getLogger()
+
+
+class AIMDController:
+    """
+    Adaptive concurrency limit for one provider, in the style of TCP
+    congestion control.
+
+    While requests succeed and latency stays within `latency_tolerance` times
+    the best latency seen so far, the limit grows additively by about
+    `increase` per window of `limit` completions. A rate-limit or 5xx
+    response cuts it multiplicatively by `decrease`, at most once per
+    `cooldown` seconds, so one burst of 429s is not punished repeatedly.
+
+    Used as `async with controller:` around each attempt.
+    """
+
+    def __init__(self, name, initial=8, min_limit=1, max_limit=256, increase=1.0, decrease=0.5,
+                 latency_tolerance=2.0, cooldown=2.0, log_interval=10.0):
+        self.name = name
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.log_interval = log_interval
+        self.in_flight = 0
+        self.ewma_latency = None
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.started_at = time.monotonic()
+        self.last_log = self.started_at
+        self.history = [(0.0, self.limit)]
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency):
+        self.successes += 1
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = 0.9 * self.ewma_latency + 0.1 * latency
+        if self.best_latency is None or self.ewma_latency < self.best_latency:
+            self.best_latency = self.ewma_latency
+
+        if self.ewma_latency <= self.latency_tolerance * self.best_latency:
+            self._set_limit(self.limit + self.increase / self.limit)
+        self._maybe_log()
+
+    def on_overload(self):
+        """Called on a rate-limit (429) or server-side (5xx) response."""
+        self.failures += 1
+        now = time.monotonic()
+        if now - self.last_decrease >= self.cooldown:
+            self.last_decrease = now
+            self._set_limit(self.limit * self.decrease)
+            logger.info(f"[{self.name}] overloaded, concurrency cut to {int(self.limit)}")
+        self._maybe_log()
+
+    def _set_limit(self, limit):
+        old_limit = int(self.limit)
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        if int(self.limit) != old_limit:
+            self.history.append((time.monotonic() - self.started_at, self.limit))
+
+    def _maybe_log(self):
+        now = time.monotonic()
+        if now - self.last_log >= self.log_interval:
+            self.last_log = now
+            latency = f"{self.ewma_latency:.2f}s" if self.ewma_latency is not None else "n/a"
+            logger.info(f"[{self.name}] concurrency={int(self.limit)} in_flight={self.in_flight} "
+                        f"latency={latency} successes={self.successes} overloads={self.failures}")
+
+    def summary(self):
+        limits = [limit for _, limit in self.history]
+        return {
+            'final': int(self.limit),
+            'min': int(min(limits)),
+            'max': int(max(limits)),
+            'successes': self.successes,
+            'overloads': self.failures
+        }
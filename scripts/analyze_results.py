@@ -7,16 +7,13 @@ from langchain_core.exceptions import OutputParserException
 from langchain_core.pydantic_v1 import BaseModel, Field
 from pydantic import BaseModel, ValidationError
 from llm_evaluators.parsers import *
+#run as `python -m scripts.analyze_results` from the repo root, or from scripts/
+try:
+    from scripts.jsonl_stream import JsonlFile
+except ModuleNotFoundError:
+    from jsonl_stream import JsonlFile
 
 
-
-def read_jsonl(file_name):
-    results_data = []
-    with open(file_name) as f:
-        for line in f:
-            results_data.append(json.loads(line))
-    return results_data
-
 class CustomJsonOutputParser:
     """
     A custom JSON output parser that extracts the outermost JSON object from a string,
@@ -624,7 +621,7 @@ def parse_args():
 
 def main(args):
     if args.type == 'single_vanilla_cot':
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         results, changed, changed_ids, unprocessed_ids, errors = analyze_single_vanilla_cot_batch_result(data)
         print(f"Total number of results: {len(data)/2}")
         print(f"Total number of changed results: {changed}")
@@ -633,7 +630,7 @@ def main(args):
         print(f"Unprocessed ids: {unprocessed_ids}")
         print(f"Errors: {errors}")
     elif args.type == 'single_axes_rubrics' or args.type == 'single_axes_rubrics_inc':
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         results, changed, changed_ids, unprocessed_ids, errors = analyze_single_axes_rubrics_batch_result(data)
         for axes, inst in results.items():
             print("*********************")
@@ -645,7 +642,7 @@ def main(args):
             print(f"Unprocessed ids: {unprocessed_ids[axes]}")
             print(f"Errors: {errors}")
     elif args.type == 'single_vanilla':
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         results, changed, changed_ids, unprocessed_ids, errors = analyze_single_vanilla_batch_result(data)
         print(f"Total number of results: {len(data)/2}")
         print(f"Total number of changed results: {changed}")
@@ -654,7 +651,7 @@ def main(args):
         print(f"Unprocessed ids: {unprocessed_ids}")
         print(f"Errors: {errors}")
     elif args.type == 'single_axes':
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         results, changed, changed_ids, unprocessed_ids, errors = analyze_single_axes_batch_result(data)
         for axes, inst in results.items():
             print("*********************")
@@ -666,7 +663,7 @@ def main(args):
             print(f"Unprocessed ids: {unprocessed_ids[axes]}")
             print(f"Errors: {errors}")
     elif args.type == 'single_rubrics' or args.type == 'single_rubrics_inc':
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         results, changed, changed_ids, unprocessed_ids, errors = analyze_single_rubrics_batch_result(data)
         print(f"Total number of results: {len(data)/2}")
         print(f"Total number of changed results: {changed}")
@@ -676,11 +673,11 @@ def main(args):
         print(f"Errors: {errors}")
     elif args.type == 'compare_vanilla_cot':
         #analyzing normal mode results
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         normal_results, normal_value_counts, normal_errors, normal_error_ids = analyze_compare_vanilla_cot_batch_result(data)
         
         #analyzing perturbed mode results
-        perturbed_data = read_jsonl(args.file_name.split(".jsonl_out")[0] + "_perturbed.jsonl_outputs.jsonl")
+        perturbed_data = JsonlFile(args.file_name.split(".jsonl_out")[0] + "_perturbed.jsonl_outputs.jsonl")
         perturbed_results, perturbed_value_counts, perturbed_errors, perturbed_error_ids = analyze_compare_vanilla_cot_batch_result(perturbed_data)
         
         common_error_ids = set(normal_error_ids).intersection(set(perturbed_error_ids))
@@ -691,11 +688,11 @@ def main(args):
         print("Error Counts: ", error_counts)
         print("Parsing Errors: ", len(common_error_ids))
     elif args.type == 'compare_rules':
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         normal_results, normal_value_counts, normal_errors, normal_error_ids = analyze_compare_rules_batch_result(data)
         
         #analyzing perturbed mode results
-        perturbed_data = read_jsonl(args.file_name.split(".jsonl_out")[0] + "_perturbed.jsonl_outputs.jsonl")
+        perturbed_data = JsonlFile(args.file_name.split(".jsonl_out")[0] + "_perturbed.jsonl_outputs.jsonl")
         perturbed_results, perturbed_value_counts, perturbed_errors, perturbed_error_ids = analyze_compare_rules_batch_result(perturbed_data)
         
         common_error_ids = set(normal_error_ids).intersection(set(perturbed_error_ids))
@@ -708,12 +705,12 @@ def main(args):
         print("Parsing Errors: ", len(common_error_ids))
     
     elif args.type == 'compare_axes' or args.type == 'compare_axes_nr':
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         normal_results, normal_value_counts, normal_errors, normal_error_ids = analyze_compare_axes_batch_result(data)
 
         # print(normal_value_counts)
         #analyzing perturbed mode results
-        perturbed_data = read_jsonl(args.file_name.split(".jsonl_out")[0] + "_perturbed.jsonl_outputs.jsonl")
+        perturbed_data = JsonlFile(args.file_name.split(".jsonl_out")[0] + "_perturbed.jsonl_outputs.jsonl")
         perturbed_results, perturbed_value_counts, perturbed_errors, perturbed_error_ids = analyze_compare_axes_batch_result(perturbed_data)
         
         # print(perturbed_value_counts)
@@ -727,11 +724,11 @@ def main(args):
         
     elif args.type == 'compare_vanilla':
         #analyzing normal mode results
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         normal_results, normal_value_counts, normal_errors, normal_error_ids = analyze_compare_vanilla_batch_result(data)
         
         #analyzing perturbed mode results
-        perturbed_data = read_jsonl(args.file_name.split(".jsonl_out")[0] + "_perturbed.jsonl_outputs.jsonl")
+        perturbed_data = JsonlFile(args.file_name.split(".jsonl_out")[0] + "_perturbed.jsonl_outputs.jsonl")
         perturbed_results, perturbed_value_counts, perturbed_errors, perturbed_error_ids = analyze_compare_vanilla_batch_result(perturbed_data)
         
         common_error_ids = set(normal_error_ids).intersection(set(perturbed_error_ids))
@@ -742,7 +739,7 @@ def main(args):
         print("Error Counts: ", error_counts)
         print("Parsing Errors: ", len(common_error_ids))
     elif args.type == 'reference':
-        data = read_jsonl(args.file_name)
+        data = JsonlFile(args.file_name)
         results, value_counts, errors = analyze_reference_batch_result(data)
         
         print(f"Total number of results: {len(data)}")
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from openai import OpenAI, AsyncOpenAI
+from anthropic import Anthropic, AsyncAnthropic
+from google.generativeai import GenerativeModel
+
+
+GEMINI_SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_NONE",
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_NONE",
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_NONE",
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_NONE",
+    },
+]
+
+# Clients are expensive to build (TLS handshake, connection pool, HTTP client),
+# so each process keeps one per configuration and reuses it for every request.
+# This lives in its own module so joblib workers import it by reference and
+# keep the registry alive across tasks.
+_CLIENT_REGISTRY = {}
+_GEMINI_CONFIGURED = None
+_GEMINI_LOCK = threading.Lock()
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def get_client(provider, base_url = None, api_key = None, generation_config = None, is_async = False, max_retries = None):
+    """
+    Returns the client for a (provider, base_url, api_key, generation config)
+    combination, creating it on first use. Every request with the same key
+    shares the client and therefore its keep-alive connection pool.
+    
+    For Gemini, `generation_config` holds the model name, generation config
+    and system instruction, since those are bound to the GenerativeModel.
+    `max_retries` overrides the OpenAI/Anthropic SDK's own retry count.
+    Async clients are bound to the event loop they were created in, so they
+    are also keyed by the running loop.
+    """
+    global _GEMINI_CONFIGURED
+    loop_id = id(asyncio.get_running_loop()) if is_async else None
+    key = (provider, base_url, api_key, _freeze(generation_config), loop_id, max_retries)
+    client = _CLIENT_REGISTRY.get(key)
+    if client is not None:
+        return client
+    
+    client_kwargs = {'base_url': base_url, 'api_key': api_key}
+    if max_retries is not None:
+        client_kwargs['max_retries'] = max_retries
+    if provider == 'openai':
+        client_cls = AsyncOpenAI if is_async else OpenAI
+        client = client_cls(**client_kwargs)
+    elif provider == 'anthropic':
+        client_cls = AsyncAnthropic if is_async else Anthropic
+        client = client_cls(**client_kwargs)
+    elif provider == 'gemini':
+        #genai keeps one global key, so with a key pool the model is bound to its
+        #key's client right away instead of on its first request
+        with _GEMINI_LOCK:
+            if _GEMINI_CONFIGURED != (api_key, base_url):
+                if base_url:
+                    genai.configure(api_key = api_key, transport = 'rest', client_options = {'api_endpoint': base_url})
+                else:
+                    genai.configure(api_key = api_key)
+                _GEMINI_CONFIGURED = (api_key, base_url)
+            client = GenerativeModel(
+                model_name = generation_config['model'],
+                safety_settings = GEMINI_SAFETY_SETTINGS,
+                generation_config = generation_config['generation_config'],
+                system_instruction = generation_config['system_instruction']
+            )
+            client._client = genai_client.get_default_generative_client()
+            if is_async and not base_url:
+                client._async_client = genai_client.get_default_generative_async_client()
+    else:
+        raise ValueError(f"Unknown provider: {provider}")
+    #another thread may have raced us here; keep whichever client landed first
+    return _CLIENT_REGISTRY.setdefault(key, client)
@@ -1,11 +1,303 @@
 import os
-import json
+import sys
+import time
+import shutil
 import argparse
+import tempfile
+import subprocess
+import openai
 from openai import OpenAI
+from merge_shards import merge_shards
+from job_store import JobStore
 
 
-API_KEY = os.environ['OPENAI_API_KEY']
-client = OpenAI(api_key=API_KEY)
+# Created on first use, so that importing this module (e.g. for hybrid_call.py --dry_run) needs no API key
+_client = None
+
+# Per-file limits of the Batch API
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_MB = 200
+
+# A batch in one of these states will not change any more
+FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def get_batch_client():
+    global _client
+    if _client is None:
+        _client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+    return _client
+
+
+def chunk_lines(file_name, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_MB * 10**6):
+    """
+    Splits a JSONL file into consecutive runs of lines that each fit in one
+    batch input file. Yields lists of lines (as bytes), so a chunk is at most
+    `max_bytes` in memory.
+    """
+    chunk = []
+    chunk_bytes = 0
+    with open(file_name, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            if len(line) > max_bytes:
+                raise ValueError(f"Line {line_number} of {file_name} is {len(line)} bytes, over the batch limit of {max_bytes}")
+            if chunk and (len(chunk) >= max_requests or chunk_bytes + len(line) > max_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(line)
+            chunk_bytes += len(line)
+    if chunk:
+        yield chunk
+
+
+def create_batch(file, job_desc):
+    batch_input_file = get_batch_client().files.create(
+        file=file,
+        purpose="batch"
+    )
+    return get_batch_client().batches.create(
+        input_file_id=batch_input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={
+            "description": job_desc
+        }
+    )
+
+def create_batches(args, store):
+    """
+    Submits the input file as one batch per chunk and records them in the
+    job store as one job named `args.job_name`. By default the job is named
+    after the input file and the last two directories of the data path, as
+    the evaluators write the same file names into different directories.
+    Each batch is recorded as soon as it is created, so a run that fails
+    part way still records the batches it created.
+    """
+    path = '/'.join(args.data_path.rstrip('/').split('/')[-2:])
+    job_name = args.job_name or f"{path}/{args.input_file_name}"
+    try:
+        store.create_job(job_name, args.input_file_name, path, os.path.abspath(args.data_path), args.job_desc)
+    except ValueError as e:
+        raise ValueError(f"{e}; pass --job_name to submit {args.input_file_name} again under another name") from None
+
+    first_request = 0
+    chunks = chunk_lines(f"{args.data_path}/{args.input_file_name}", args.max_batch_requests, int(args.max_batch_mb * 10**6))
+    for chunk_idx, chunk in enumerate(chunks):
+        with tempfile.TemporaryFile() as f:
+            f.writelines(chunk)
+            f.seek(0)
+            chunk_name = f"{os.path.splitext(args.input_file_name)[0]}.part{chunk_idx}.jsonl"
+            req = create_batch((chunk_name, f), args.job_desc)
+        store.add_batch(job_name, chunk_idx, req.id, first_request, len(chunk), sum(len(line) for line in chunk), req.status)
+        print(f"Created batch {req.id} with requests {first_request}-{first_request + len(chunk) - 1}")
+        first_request += len(chunk)
+    print(f"Job {job_name}: {len(store.batches(job_name))} batches, {first_request} requests")
+
+
+def check_status(args, store):
+    if store.get_job(args.job_name) is None:
+        print(get_batch_client().batches.retrieve(args.job_name))
+        return
+    counts = dict()
+    for batch in store.batches(args.job_name):
+        status = get_batch_client().batches.retrieve(batch["batch_id"])
+        counts[status.status] = counts.get(status.status, 0) + 1
+        print(f"{batch['batch_id']}: {status.status}, {status.request_counts}")
+    print(f"Job {args.job_name}: " + ', '.join(f"{n} {state}" for state, n in counts.items()))
+
+
+def get_results(args, store):
+    """
+    For a job in the store, concatenates the outputs of its batches in chunk
+    order, once all of them have reached a final state, and their errors
+    into OUTPUT.errors.jsonl. Each file is streamed to a part file first.
+    Batches that failed, expired or were cancelled contribute whatever
+    output they have and are listed. Anything else is taken to be a file
+    id, as before. Returns 1 if the job is not finished or has such
+    batches, else 0.
+    """
+    output_file = f"{args.data_path}/{args.output_file_name}"
+    if store.get_job(args.job_name) is None:
+        download_file(args.job_name, output_file)
+        return 0
+
+    statuses = [get_batch_client().batches.retrieve(batch["batch_id"]) for batch in store.batches(args.job_name)]
+    pending = [status.id for status in statuses if status.status not in FINAL_STATES]
+    if pending:
+        print(f"Job {args.job_name} is not finished, {len(pending)} batches are still running: {', '.join(pending)}")
+        return 1
+    n_errors = 0
+    output_parts = []
+    error_parts = []
+    for status in statuses:
+        if status.output_file_id is not None:
+            output_parts.append(f"{output_file}.{status.id}.part")
+            download_file(status.output_file_id, output_parts[-1])
+        if status.error_file_id is not None:
+            error_parts.append(f"{output_file}.{status.id}.errors.part")
+            n_errors += download_file(status.error_file_id, error_parts[-1])
+    for file_name, parts in [(output_file, output_parts), (f"{output_file}.errors.jsonl", error_parts)]:
+        if file_name != output_file and not parts:
+            continue
+        with open(file_name, 'wb') as out:
+            for part_file in parts:
+                with open(part_file, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+                os.remove(part_file)
+    if n_errors:
+        print(f"{n_errors} requests failed, see {output_file}.errors.jsonl")
+    failed = [status for status in statuses if status.status != "completed"]
+    for status in failed:
+        print(f"Batch {status.id} {status.status}, {status.request_counts}, error file: {status.error_file_id}")
+    if failed:
+        print(f"Job {args.job_name}: {len(failed)} of {len(statuses)} batches did not complete, their finished requests are in {output_file}")
+        return 1
+    return 0
+
+
+def download_file(file_id, file_name, chunk_size=1 << 20):
+    """
+    Streams a JSONL file to disk in chunks of `chunk_size` bytes, replacing
+    `file_name` only once it is complete, and returns its number of lines.
+    """
+    tmp_file_name = file_name + '.tmp'
+    lines = 0
+    last_byte = b'\n'
+    with get_batch_client().files.with_streaming_response.content(file_id) as response:
+        with open(tmp_file_name, 'wb') as f:
+            for chunk in response.iter_bytes(chunk_size):
+                if not chunk:
+                    continue
+                f.write(chunk)
+                lines += chunk.count(b'\n')
+                last_byte = chunk[-1:]
+            #so that files can be concatenated
+            if last_byte != b'\n':
+                f.write(b'\n')
+                lines += 1
+    os.replace(tmp_file_name, file_name)
+    return lines
+
+
+def job_output_file(job, data_path):
+    job_dir = job["data_path"] or os.path.join(data_path, job["path"])
+    return os.path.join(job_dir, f"{job['input_file']}_outputs.jsonl")
+
+
+def poll_job(store, job, data_path):
+    """
+    Checks the unfinished batches of a job and downloads the output and
+    error files of those that reached a final state. Returns True if any
+    batch changed state.
+    """
+    output_file = job_output_file(job, data_path)
+    changed = False
+    for batch in store.batches(job["job_name"]):
+        if batch["status"] in FINAL_STATES:
+            continue
+        status = get_batch_client().batches.retrieve(batch["batch_id"])
+        if status.status == batch["status"]:
+            continue
+        changed = True
+        files = dict()
+        if status.status in FINAL_STATES:
+            #an expired or cancelled batch still has the results of the requests that finished
+            if status.output_file_id is not None:
+                files["output_file"] = f"{output_file}.{batch['batch_id']}.part"
+                download_file(status.output_file_id, files["output_file"])
+            if status.error_file_id is not None:
+                files["error_file"] = f"{output_file}.{batch['batch_id']}.errors.part"
+                download_file(status.error_file_id, files["error_file"])
+        store.update_batch(batch["batch_id"], status=status.status, output_file_id=status.output_file_id,
+                           error_file_id=status.error_file_id, **files)
+        print(f"[{job['job_name']}] batch {batch['batch_id']}: {status.status}, {status.request_counts}")
+    return changed
+
+
+def assemble_job(store, job, data_path):
+    """
+    Merges the downloaded outputs of a finished job into
+    FILE_outputs.jsonl, in input order when the input file is still there,
+    and its error files into FILE_outputs.jsonl.errors.jsonl. Returns the
+    output file name.
+    """
+    output_file = job_output_file(job, data_path)
+    batches = store.batches(job["job_name"])
+    part_files = [batch["output_file"] for batch in batches if batch["output_file"]]
+    input_file = os.path.join(os.path.dirname(output_file), job["input_file"])
+    if os.path.exists(input_file):
+        merged, gaps, duplicates, unknown, unreadable = merge_shards(input_file, part_files, output_file, keep_unknown=True)
+        print(f"[{job['job_name']}] {merged} results in {output_file}, {len(gaps)} requests without a result")
+    else:
+        with open(output_file, 'wb') as out:
+            for part_file in part_files:
+                with open(part_file, 'rb') as f:
+                    out.writelines(f)
+    error_files = [batch["error_file"] for batch in batches if batch["error_file"]]
+    if error_files:
+        with open(f"{output_file}.errors.jsonl", 'wb') as out:
+            for error_file in error_files:
+                with open(error_file, 'rb') as f:
+                    out.writelines(f)
+        print(f"[{job['job_name']}] failed requests are in {output_file}.errors.jsonl")
+    store.finish_job(job["job_name"], output_file)
+    for file_name in part_files + error_files:
+        os.remove(file_name)
+    return output_file
+
+
+def analyze(output_file, analyze_type, num_axes):
+    """
+    Runs analyze_results.py on a merged output file. It is run as a module
+    from the repo root, where llm_evaluators can be imported. Returns True
+    if it succeeded.
+    """
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    completed = subprocess.run([sys.executable, '-m', 'scripts.analyze_results', '--file_name', os.path.abspath(output_file),
+                                '--type', analyze_type, '--num_axes', str(num_axes)], cwd=repo_root)
+    if completed.returncode != 0:
+        print(f"analyze_results.py failed on {output_file} (exit code {completed.returncode})")
+    return completed.returncode == 0
+
+
+def watch(args, store):
+    """
+    Polls every unfinished job in the job store (or only `args.job_name`)
+    until all of their batches reach a final state. Outputs are downloaded
+    as each batch finishes and merged once its whole job has, then
+    optionally analyzed with analyze_results.py. The poll interval grows by
+    half while nothing changes, up to `args.max_poll_interval`, and API
+    errors are retried at the next poll. Progress is saved in the store, so
+    a stopped watcher picks up where it left off.
+    """
+    interval = args.poll_interval
+    while True:
+        jobs = [job for job in store.jobs(unfinished=True) if args.job_name in (None, job["job_name"])]
+        if not jobs:
+            print("All jobs are finished")
+            return
+        changed = False
+        finished = 0
+        for job in jobs:
+            try:
+                changed = poll_job(store, job, args.data_path) or changed
+            except (openai.APIConnectionError, openai.APIStatusError) as e:
+                print(f"[{job['job_name']}] polling failed, retrying later: {e}")
+                continue
+            if all(batch["status"] in FINAL_STATES for batch in store.batches(job["job_name"])):
+                output_file = assemble_job(store, job, args.data_path)
+                finished += 1
+                if args.analyze_type is not None:
+                    analyze(output_file, args.analyze_type, args.num_axes)
+        if finished == len(jobs):
+            continue
+        interval = args.poll_interval if changed else min(interval * 1.5, args.max_poll_interval)
+        time.sleep(interval)
 
 
 def parse_args():
@@ -13,58 +305,40 @@ def parse_args():
     parser.add_argument('--create_batch', action="store_true", help='Create a batch job')
     parser.add_argument('--get_results', action="store_true", help='Get results from batch job')
     parser.add_argument('--check_status', action="store_true", help='Check status of batch job')
-    parser.add_argument('--job_name', type=str, help='File name of batch job')
+    parser.add_argument('--watch', action="store_true", help='Poll the jobs in the job store and download, merge and optionally analyze their outputs as they finish')
+    parser.add_argument('--job_name', type=str, help='Name of the job in the job store (DIR/SUBDIR/FILE of the input by default when creating, see job_store.py --list), or a batch / file id')
     parser.add_argument('--input_file_name', type=str, help='File name of batch job')
     parser.add_argument('--output_file_name', type=str, help='File name of batch job')
     parser.add_argument('--job_desc', type=str, help='Description of batch job')
     parser.add_argument('--data_path', type=str, default='/Users/sumanth/code/fbi/data', help='Path to data directory')
+    parser.add_argument('--job_store', type=str, default='jobs.sqlite', help='Job store that records the batches of each job')
+    parser.add_argument('--max_batch_requests', type=int, default=MAX_BATCH_REQUESTS, help='Split the input into batches of at most this many requests')
+    parser.add_argument('--max_batch_mb', type=float, default=MAX_BATCH_MB, help='Split the input into batch files of at most this many MB')
+    parser.add_argument('--poll_interval', type=float, default=30, help='Seconds between polls in --watch mode, while batches are changing state')
+    parser.add_argument('--max_poll_interval', type=float, default=600, help='Longest wait between polls in --watch mode when nothing changes')
+    parser.add_argument('--analyze_type', type=str, default=None, help='Run analyze_results.py with this --type on each merged output in --watch mode')
+    parser.add_argument('--num_axes', type=int, default=5, help='--num_axes for analyze_results.py')
     args = parser.parse_args()
     return args
 
 def main(args):
+    store = JobStore(args.job_store)
+    status = 0
     if args.create_batch:
-        batch_input_file = client.files.create(
-        file=open(f"{args.data_path}/{args.input_file_name}", "rb"),
-        purpose="batch"
-        )
-        batch_input_file_id = batch_input_file.id
-
-        req = client.batches.create(
-            input_file_id=batch_input_file_id,
-            endpoint="/v1/chat/completions",
-            completion_window="24h",
-            metadata={
-            "description": args.job_desc
-            }
-        )
-
-        if not os.path.exists('tracking.json'):
-            with open('tracking.json', 'w') as f:
-                json.dump([], f)
-        
-        with open('tracking.json') as f:
-            data = json.load(f)
-            data.append(
-                {
-                    "batch_id": req.id,
-                    "file_name": args.input_file_name,
-                    "path": '/'.join(args.data_path.split('/')[-2:])
-                }
-            )
-        
-        with open('tracking.json', 'w') as f:
-            json.dump(data, f, indent=4)
+        create_batches(args, store)
 
     elif args.get_results:
-        content = client.files.content(args.job_name)
-        with open(f"{args.data_path}/{args.output_file_name}", "w") as f:
-            for line in content:
-                f.write(json.dumps(line) + "\n")
+        status = get_results(args, store)
 
     elif args.check_status:
-        print(client.batches.retrieve(args.job_name))
+        check_status(args, store)
+
+    elif args.watch:
+        watch(args, store)
+    store.close()
+    return status
 
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args)
\ No newline at end of file
+    sys.exit(main(args))
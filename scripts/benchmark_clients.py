@@ -0,0 +1,82 @@
+import time
+import argparse
+import statistics
+from openai import OpenAI
+from api_clients import get_client
+from mock_llm_server import MockLLMServer
+
+
+def make_request(i):
+    return {
+        'custom_id': f'{i}~orig',
+        'body': {
+            'model': 'gpt-4o',
+            'messages': [
+                {'role': 'system', 'content': 'You are a helpful assistant.'},
+                {'role': 'user', 'content': f'Question {i}'}
+            ],
+            'max_tokens': 16,
+            'temperature': 0
+        }
+    }
+
+
+def fresh_client_call(base_url, data_dict):
+    # the behaviour before the client registry: one client per request
+    client = OpenAI(base_url=base_url, api_key='mock')
+    return client.chat.completions.create(
+        model=data_dict['body']['model'],
+        messages=data_dict['body']['messages'],
+        max_tokens=data_dict['body']['max_tokens'],
+        temperature=data_dict['body']['temperature']
+    )
+
+
+def registry_client_call(base_url, data_dict):
+    client = get_client('openai', base_url=base_url, api_key='mock')
+    return client.chat.completions.create(
+        model=data_dict['body']['model'],
+        messages=data_dict['body']['messages'],
+        max_tokens=data_dict['body']['max_tokens'],
+        temperature=data_dict['body']['temperature']
+    )
+
+
+def time_calls(call_fn, base_url, n_requests):
+    latencies = []
+    for i in range(n_requests):
+        start = time.perf_counter()
+        call_fn(base_url, make_request(i))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    print(f"{name:<16} mean={statistics.mean(latencies):7.2f}ms  p50={statistics.median(latencies):7.2f}ms  p95={p95:7.2f}ms")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark per-request vs shared API clients')
+    parser.add_argument("--n_requests", type=int, default=500, help="Number of sequential requests per variant")
+    return parser.parse_args()
+
+
+def main(args):
+    #zero service latency, so only client setup and connection reuse are measured
+    server = MockLLMServer(latency='constant', latency_mean_ms=0).start()
+    base_url = f"{server.base_url}/v1"
+
+    #warm up both paths so imports and the first connection are not counted
+    time_calls(fresh_client_call, base_url, 5)
+    time_calls(registry_client_call, base_url, 5)
+
+    report("fresh client", time_calls(fresh_client_call, base_url, args.n_requests))
+    report("shared client", time_calls(registry_client_call, base_url, args.n_requests))
+    server.stop()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import shlex
+import argparse
+import tempfile
+from mock_llm_server import MockLLMServer, mock_env
+
+
+def write_synthetic_input(file_name, n_requests, models, prompt_chars):
+    with open(file_name, 'w') as f:
+        for i in range(n_requests):
+            data_dict = {
+                "custom_id": f"{i}~orig",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": models[i % len(models)],
+                    "messages": [
+                        {"role": "system", "content": "You are a helpful evaluator."},
+                        {"role": "user", "content": f"Request {i}: " + "x" * prompt_chars}
+                    ],
+                    "max_tokens": 100,
+                    "temperature": 0
+                }
+            }
+            f.write(json.dumps(data_dict) + '\n')
+
+
+def run_scenario(parallel_call, server, name, argv):
+    server.reset()
+    args = parallel_call.parse_args(argv)
+    start = time.perf_counter()
+    parallel_call.main(args)
+    elapsed = time.perf_counter() - start
+    stats = server.stats()
+    with open(f"{args.output_file_name[0]}.metrics.summary.json") as f:
+        total = json.load(f)['total']
+    return {
+        'scenario': name,
+        'seconds': elapsed,
+        'requests_per_s': total['requests'] / elapsed if elapsed > 0 else 0.0,
+        'results': total['requests'],
+        'errors': total['errors'],
+        'retries': total['retries'],
+        'hedges': total['hedges'],
+        'rate_limited': stats['rate_limited'],
+        'malformed': stats['malformed'],
+        'p50_ms': 1000 * (total['latency_p50'] or 0.0),
+        'p95_ms': 1000 * (total['latency_p95'] or 0.0),
+        'p99_ms': 1000 * (total['latency_p99'] or 0.0)
+    }
+
+
+def print_report(rows):
+    header = f"{'scenario':<28}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'retries':>9}{'hedges':>8}{'429s':>7}{'errors':>8}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['scenario']:<28}{row['requests_per_s']:>9.1f}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+              f"{row['p99_ms']:>9.1f}{row['retries']:>9}{row['hedges']:>8}{row['rate_limited']:>7}{row['errors']:>8}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load-test parallel_call.py against a local mock LLM server')
+    parser.add_argument("--n_requests", type=int, default=2000, help="Number of synthetic requests per scenario")
+    parser.add_argument("--models", type=str, nargs='+', default=['gpt-4o'], help="Models to spread the requests over")
+    parser.add_argument("--prompt_chars", type=int, default=2000, help="Length of each synthetic prompt")
+    parser.add_argument("--scenarios", type=str, nargs='+', default=['joblib', 'async'], help="Scenarios to run: joblib, async, adaptive, hedged")
+    parser.add_argument("--n_jobs", type=int, default=16, help="--n_jobs for the joblib scenario")
+    parser.add_argument("--max_concurrency", type=int, default=256, help="--max_concurrency for the async scenarios")
+    parser.add_argument("--extra_args", type=str, default='', help="Extra parallel_call.py arguments for every scenario, e.g. \"--rpm 6000\"")
+    parser.add_argument("--latency", type=str, default='lognormal', choices=['constant', 'uniform', 'exponential', 'lognormal'], help="Mock latency distribution")
+    parser.add_argument("--latency_mean_ms", type=float, default=200.0, help="Mock mean service latency in milliseconds")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="Shape of the lognormal latency distribution")
+    parser.add_argument("--rate_limit_prob", type=float, default=0.02, help="Probability of a 429 per attempt")
+    parser.add_argument("--malformed_prob", type=float, default=0.0, help="Probability of a malformed JSON response per attempt")
+    parser.add_argument("--capacity", type=int, default=None, help="Mock answers with 429 beyond this many in-flight requests")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the mock server")
+    return parser.parse_args()
+
+def main(args):
+    server = MockLLMServer(latency=args.latency, latency_mean_ms=args.latency_mean_ms, latency_sigma=args.latency_sigma,
+                           rate_limit_prob=args.rate_limit_prob, malformed_prob=args.malformed_prob,
+                           capacity=args.capacity, seed=args.seed).start()
+    #parallel_call reads keys and base urls at import time
+    os.environ.update(mock_env(server.base_url))
+    import parallel_call
+
+    work_dir = tempfile.mkdtemp(prefix='fbi_bench_')
+    input_file = os.path.join(work_dir, 'input.jsonl')
+    write_synthetic_input(input_file, args.n_requests, args.models, args.prompt_chars)
+
+    scenario_args = {
+        'joblib': ['--n_jobs', str(args.n_jobs)],
+        'async': ['--async_mode', '--max_concurrency', str(args.max_concurrency)],
+        'adaptive': ['--async_mode', '--adaptive', '--max_concurrency', str(args.max_concurrency)],
+        'hedged': ['--async_mode', '--hedge', '--max_concurrency', str(args.max_concurrency)]
+    }
+    rows = []
+    for scenario in args.scenarios:
+        argv = ['--input_file_name', input_file,
+                '--output_file_name', os.path.join(work_dir, f'{scenario}_outputs.jsonl'),
+                '--no-cache'] + scenario_args[scenario] + shlex.split(args.extra_args)
+        rows.append(run_scenario(parallel_call, server, scenario, argv))
+
+    server.stop()
+    print_report(rows)
+    print(f"Inputs and outputs in {work_dir}")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import resource
+import multiprocessing
+from benchmark_dispatch import write_synthetic_input
+from mock_llm_server import MockLLMServer, mock_env
+
+
+def peak_rss_mb():
+    #ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def read_list(file_name):
+    #how read_jsonl used to load inputs
+    results_data = []
+    with open(file_name) as f:
+        for line in f:
+            results_data.append(json.loads(line))
+    return len(results_data)
+
+def read_stream(file_name):
+    from jsonl_stream import read_jsonl
+    return sum(1 for _ in read_jsonl(file_name))
+
+def dispatch(file_name, env, extra_argv):
+    os.environ.update(env)
+    import parallel_call
+    argv = ['--input_file_name', file_name, '--output_file_name', file_name + '_outputs.jsonl', '--no-cache'] + extra_argv
+    parallel_call.main(parallel_call.parse_args(argv))
+    with open(file_name + '_outputs.jsonl') as f:
+        return sum(1 for _ in f)
+
+
+def run_in_child(queue, fn, fn_args):
+    start = time.perf_counter()
+    n_lines = fn(*fn_args)
+    queue.put((n_lines, time.perf_counter() - start, peak_rss_mb()))
+
+def measure(fn, *fn_args):
+    """Runs `fn` in a fresh interpreter and returns (lines, seconds, peak RSS in MB)."""
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_in_child, args=(queue, fn, fn_args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def print_report(rows):
+    header = f"{'scenario':<32}{'lines':>10}{'seconds':>10}{'peak RSS MB':>14}"
+    print(header)
+    print('-' * len(header))
+    for name, n_lines, seconds, rss in rows:
+        print(f"{name:<32}{n_lines:>10}{seconds:>10.1f}{rss:>14.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure peak memory of reading and dispatching large JSONL inputs')
+    parser.add_argument("--n_lines", type=int, default=1000000, help="Lines in the synthetic file for the read scenarios")
+    parser.add_argument("--dispatch_lines", type=int, nargs='*', default=[10000, 100000], help="Input sizes for the dispatch scenario; peak memory should not grow with them")
+    parser.add_argument("--prompt_chars", type=int, default=200, help="Length of each synthetic prompt")
+    parser.add_argument("--dispatch_args", type=str, nargs='*', default=['--async_mode', '--max_concurrency', '64'], help="parallel_call.py arguments for the dispatch scenario")
+    return parser.parse_args()
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix='fbi_mem_')
+    rows = []
+
+    input_file = os.path.join(work_dir, 'input.jsonl')
+    write_synthetic_input(input_file, args.n_lines, ['gpt-4o'], args.prompt_chars)
+    print(f"Synthetic input: {args.n_lines} lines, {os.path.getsize(input_file) / 2**20:.0f} MB")
+    rows.append(('read into a list', *measure(read_list, input_file)))
+    rows.append(('stream (read_jsonl)', *measure(read_stream, input_file)))
+
+    if args.dispatch_lines:
+        server = MockLLMServer(latency='constant', latency_mean_ms=0).start()
+        for n_lines in args.dispatch_lines:
+            dispatch_file = os.path.join(work_dir, f'dispatch_{n_lines}.jsonl')
+            write_synthetic_input(dispatch_file, n_lines, ['gpt-4o'], args.prompt_chars)
+            rows.append((f'dispatch {n_lines} requests', *measure(dispatch, dispatch_file, mock_env(server.base_url), args.dispatch_args)))
+        server.stop()
+
+    print_report(rows)
+    print(f"Inputs and outputs in {work_dir}")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,182 @@
+import time
+import asyncio
+import logging
+import threading
+from provider_config import get_provider_setting
+
+
+logger = logging.getLogger()
+
+# Shared breakers by (provider, model), and the settings they are built from.
+_BREAKERS = dict()
+_BREAKERS_LOCK = threading.Lock()
+_BREAKER_CONFIG = dict()
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of waiting when a request finds its circuit open."""
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a provider/model that is down.
+
+    The breaker opens after `failure_threshold` consecutive failures
+    (connection errors and 5xx responses; rate limits do not count). While
+    open, `acquire` parks callers instead of letting them retry, and
+    `reserve` tells callers that cannot wait how long it will stay open
+    (they raise CircuitOpenError instead). After `reset_timeout`
+    seconds one caller is let through as a half-open probe: if it succeeds
+    the breaker closes and everyone resumes, if it fails the breaker opens
+    again with the timeout doubled, up to `max_reset_timeout`.
+
+    A `failure_threshold` of 0 disables the breaker. `clock` returns the
+    current time in seconds (time.monotonic by default).
+    """
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 max_reset_timeout=600.0, poll_interval=0.5, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.poll_interval = poll_interval
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+        self.times_opened = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Returns 0 if the caller may send a request now, otherwise how long to
+        wait before asking again.
+        """
+        if self.state == 'closed':
+            return 0.0
+        with self.lock:
+            now = self.clock()
+            if self.state == 'closed':
+                return 0.0
+            if self.state == 'open':
+                reopen_at = self.opened_at + self.reset_timeout
+                if now < reopen_at:
+                    return reopen_at - now
+                self.state = 'half_open'
+                self.probe_started_at = now
+                logger.info(f"[{self.name}] circuit half-open, sending a probe request")
+                return 0.0
+            #half-open: a probe is in flight; let another through if it was lost
+            if now - self.probe_started_at >= self.reset_timeout:
+                self.probe_started_at = now
+                return 0.0
+            return self.poll_interval
+
+    def acquire(self, max_wait=None):
+        """Waits until a request may be sent; False if that takes longer than `max_wait` seconds."""
+        give_up_at = self.clock() + max_wait if max_wait is not None else None
+        wait = self.reserve()
+        while wait > 0:
+            if give_up_at is not None:
+                wait = min(wait, give_up_at - self.clock())
+                if wait <= 0:
+                    return False
+            time.sleep(wait)
+            wait = self.reserve()
+        return True
+
+    async def acquire_async(self, max_wait=None):
+        give_up_at = self.clock() + max_wait if max_wait is not None else None
+        wait = self.reserve()
+        while wait > 0:
+            if give_up_at is not None:
+                wait = min(wait, give_up_at - self.clock())
+                if wait <= 0:
+                    return False
+            await asyncio.sleep(wait)
+            wait = self.reserve()
+        return True
+
+    def on_success(self):
+        if self.state == 'closed' and self.failures == 0:
+            return
+        with self.lock:
+            if self.state != 'closed':
+                logger.info(f"[{self.name}] circuit closed, provider is healthy again")
+            self.state = 'closed'
+            self.failures = 0
+            self.reset_timeout = self.base_reset_timeout
+
+    def on_failure(self):
+        if not self.failure_threshold:
+            return
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open':
+                self.reset_timeout = min(2 * self.reset_timeout, self.max_reset_timeout)
+                self._open()
+            elif self.state == 'closed' and self.failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.state = 'open'
+        self.opened_at = self.clock()
+        self.times_opened += 1
+        logger.warning(f"[{self.name}] circuit open after {self.failures} consecutive failures, "
+                       f"next probe in {self.reset_timeout:.0f}s")
+
+
+def configure_circuit_breakers(config, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+    """
+    Sets the settings used by `get_circuit_breaker`. `config` is a provider
+    config (see provider_config.py) whose "failure_threshold"/"reset_timeout"
+    settings override the defaults.
+    """
+    _BREAKER_CONFIG.clear()
+    _BREAKER_CONFIG.update({
+        'config': config,
+        'failure_threshold': failure_threshold,
+        'reset_timeout': reset_timeout
+    })
+    _BREAKERS.clear()
+
+
+def get_circuit_breaker(provider, model):
+    """Returns the shared breaker for (provider, model)."""
+    key = (provider, model)
+    if key in _BREAKERS:
+        return _BREAKERS[key]
+
+    with _BREAKERS_LOCK:
+        if key not in _BREAKERS:
+            config = _BREAKER_CONFIG.get('config', {})
+            failure_threshold = get_provider_setting(config, provider, model, 'failure_threshold',
+                                                     _BREAKER_CONFIG.get('failure_threshold', DEFAULT_FAILURE_THRESHOLD))
+            reset_timeout = get_provider_setting(config, provider, model, 'reset_timeout',
+                                                 _BREAKER_CONFIG.get('reset_timeout', DEFAULT_RESET_TIMEOUT))
+            _BREAKERS[key] = CircuitBreaker(f"{provider}/{model}", failure_threshold, reset_timeout)
+    return _BREAKERS[key]
+
+
+def circuit_breakers_configured():
+    """True if any breaker setting differs from the defaults."""
+    if _BREAKER_CONFIG.get('failure_threshold', DEFAULT_FAILURE_THRESHOLD) != DEFAULT_FAILURE_THRESHOLD:
+        return True
+    if _BREAKER_CONFIG.get('reset_timeout', DEFAULT_RESET_TIMEOUT) != DEFAULT_RESET_TIMEOUT:
+        return True
+    for provider_config in _BREAKER_CONFIG.get('config', {}).values():
+        for settings in [provider_config] + list(provider_config.get('models', {}).values()):
+            if 'failure_threshold' in settings or 'reset_timeout' in settings:
+                return True
+    return False
+
+
+def circuit_breaker_summary():
+    return {f"{provider}/{model}": breaker.times_opened for (provider, model), breaker in _BREAKERS.items()
+            if breaker.times_opened}
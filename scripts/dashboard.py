@@ -0,0 +1,206 @@
+import os
+import sys
+import time
+import logging
+import threading
+import collections
+from request_metrics import extract_usage
+
+
+logger = logging.getLogger()
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class ProviderCounters:
+    def __init__(self):
+        self.queued = 0
+        self.in_flight = 0
+        self.finished = 0
+        self.attempts = 0
+        self.rate_limited = 0
+        self.tokens = 0
+        self.errors = collections.Counter()
+
+
+class Dashboard:
+    """
+    Live status of a run: finished, in-flight and queued requests, requests/s
+    and tokens/s over the last `window` seconds, ETA, and the 429 rate and
+    error types per provider.
+
+    The dispatchers report each request with `on_queued` when it is read,
+    `on_started` when a worker takes it and `on_finished` with its result.
+    With `display`, the view is redrawn on stderr every `interval` seconds,
+    or logged as one line every `log_interval` seconds when stderr is not a
+    terminal. With `prometheus_file`, the counters are also written there in
+    the Prometheus text format on every tick.
+    """
+
+    def __init__(self, total=None, display=False, prometheus_file=None, interval=1.0, window=30.0, log_interval=30.0):
+        self.total = total
+        self.display = display
+        self.prometheus_file = prometheus_file
+        self.interval = interval
+        self.window = window
+        self.log_interval = log_interval
+        self.providers = collections.defaultdict(ProviderCounters)
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        #(time, {provider: (finished, attempts, rate_limited, tokens)}) once per tick
+        self.snapshots = collections.deque()
+        self.drawn_lines = 0
+        self.last_logged = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def on_queued(self, provider):
+        with self.lock:
+            self.providers[provider].queued += 1
+
+    def on_started(self, provider):
+        with self.lock:
+            counters = self.providers[provider]
+            counters.queued -= 1
+            counters.in_flight += 1
+
+    def on_finished(self, provider, result, attempts=1, rate_limited=0, started=True):
+        """`started` is False for requests answered without being queued (cache hits, unsupported models)."""
+        prompt_tokens, completion_tokens = extract_usage(result)
+        with self.lock:
+            counters = self.providers[provider]
+            if started:
+                counters.in_flight -= 1
+            counters.finished += 1
+            counters.attempts += attempts
+            counters.rate_limited += rate_limited
+            counters.tokens += prompt_tokens + completion_tokens
+            if result is None or result.get('error') is not None:
+                counters.errors[(result or {}).get('error_type') or 'Unknown'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {provider: (c.finished, c.attempts, c.rate_limited, c.tokens) for provider, c in self.providers.items()}
+
+    def rates(self, now, current):
+        """Per-provider (requests/s, tokens/s, 429s per attempt) over the window."""
+        self.snapshots.append((now, current))
+        while len(self.snapshots) > 1 and now - self.snapshots[0][0] > self.window:
+            self.snapshots.popleft()
+        then, previous = self.snapshots[0]
+        elapsed = now - then
+        rates = dict()
+        for provider, (finished, attempts, rate_limited, tokens) in current.items():
+            finished_0, attempts_0, rate_limited_0, tokens_0 = previous.get(provider, (0, 0, 0, 0))
+            rates[provider] = (
+                (finished - finished_0) / elapsed if elapsed > 0 else 0.0,
+                (tokens - tokens_0) / elapsed if elapsed > 0 else 0.0,
+                (rate_limited - rate_limited_0) / (attempts - attempts_0) if attempts > attempts_0 else 0.0
+            )
+        return rates
+
+    def eta(self, finished, requests_per_s):
+        if not self.total or requests_per_s <= 0:
+            return None
+        return max(0, self.total - finished) / requests_per_s
+
+    def render(self, now, rates):
+        with self.lock:
+            providers = {provider: (c.finished, c.in_flight, c.queued, c.errors.most_common(3)) for provider, c in self.providers.items()}
+        finished = sum(p[0] for p in providers.values())
+        requests_per_s = sum(r[0] for r in rates.values())
+        tokens_per_s = sum(r[1] for r in rates.values())
+        eta = self.eta(finished, requests_per_s)
+        done = f"{finished}/{self.total} done ({100 * finished / self.total:.1f}%)" if self.total else f"{finished} done"
+        lines = [
+            f"{done}, {format_duration(now - self.started_at)} elapsed, ETA {format_duration(eta)}, "
+            f"{requests_per_s:.1f} req/s, {tokens_per_s:.0f} tokens/s (last {self.window:.0f}s)",
+            f"  {'provider':<10}{'done':>9}{'in flight':>11}{'queued':>9}{'req/s':>8}{'429s':>7}  errors"
+        ]
+        for provider, (n_finished, in_flight, queued, errors) in sorted(providers.items(), key=lambda item: str(item[0])):
+            provider_rates = rates.get(provider, (0.0, 0.0, 0.0))
+            error_text = ', '.join(f"{error_type}: {count}" for error_type, count in errors) or '-'
+            lines.append(f"  {str(provider):<10}{n_finished:>9}{in_flight:>11}{queued:>9}{provider_rates[0]:>8.1f}"
+                         f"{100 * provider_rates[2]:>6.1f}%  {error_text}")
+        return lines
+
+    def draw(self, lines):
+        if sys.stderr.isatty():
+            #move back over the previous view and clear it
+            if self.drawn_lines:
+                sys.stderr.write(f"\x1b[{self.drawn_lines}F\x1b[J")
+            sys.stderr.write('\n'.join(lines) + '\n')
+            sys.stderr.flush()
+            self.drawn_lines = len(lines)
+        elif time.monotonic() - self.last_logged >= self.log_interval:
+            self.last_logged = time.monotonic()
+            logger.info(' | '.join(line.strip() for line in lines))
+
+    def write_prometheus(self, now, rates):
+        with self.lock:
+            providers = {provider: (c.finished, c.in_flight, c.queued, c.attempts, c.rate_limited, c.tokens, dict(c.errors))
+                         for provider, c in self.providers.items()}
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        for name, kind, help_text, field in [
+            ('llm_requests_finished_total', 'counter', 'Requests finished, including failed ones', 0),
+            ('llm_requests_in_flight', 'gauge', 'Requests taken by a worker and not finished', 1),
+            ('llm_requests_queued', 'gauge', 'Requests read and waiting for a worker', 2),
+            ('llm_attempts_total', 'counter', 'Attempts sent, including retries', 3),
+            ('llm_rate_limited_total', 'counter', 'Attempts answered with a 429', 4),
+            ('llm_tokens_total', 'counter', 'Prompt and completion tokens reported by the providers', 5)
+        ]:
+            metric(name, kind, help_text, [({'provider': provider}, values[field]) for provider, values in providers.items()])
+        metric('llm_request_errors_total', 'counter', 'Failed requests by error type',
+               [({'provider': provider, 'error_type': error_type}, count)
+                for provider, values in providers.items() for error_type, count in values[6].items()])
+        metric('llm_requests_per_second', 'gauge', f'Requests finished per second over the last {self.window:.0f}s',
+               [({'provider': provider}, round(provider_rates[0], 3)) for provider, provider_rates in rates.items()])
+        metric('llm_run_requests', 'gauge', 'Requests in the run', [({}, self.total or 0)])
+        metric('llm_run_elapsed_seconds', 'gauge', 'Seconds since the run started', [({}, round(now - self.started_at, 1))])
+        eta = self.eta(sum(values[0] for values in providers.values()), sum(r[0] for r in rates.values()))
+        if eta is not None:
+            metric('llm_run_eta_seconds', 'gauge', 'Estimated seconds until the run finishes', [({}, round(eta, 1))])
+
+        tmp_file_name = self.prometheus_file + '.tmp'
+        with open(tmp_file_name, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        #a scraper never sees a half-written file
+        os.replace(tmp_file_name, self.prometheus_file)
+
+    def tick(self):
+        now = time.monotonic()
+        rates = self.rates(now, self.snapshot())
+        if self.display:
+            self.draw(self.render(now, rates))
+        if self.prometheus_file:
+            self.write_prometheus(now, rates)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.tick()
+
+    def start(self):
+        if self.display or self.prometheus_file:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.last_logged = 0.0
+            self.tick()
@@ -0,0 +1,94 @@
+import os
+import json
+import argparse
+from jsonl_stream import read_jsonl
+from response_cache import request_hash
+from run_limits import dead_letter_entry
+
+def output_file_for(input_file, output_dir):
+    file_name = os.path.basename(input_file) + '_outputs.jsonl'
+    return os.path.join(output_dir or os.path.dirname(input_file), file_name)
+
+
+def plan(input_files, out_file):
+    """
+    Collapses requests with identical bodies across `input_files` into one
+    request each, written to `out_file` with the body hash as custom_id.
+    """
+    seen = set()
+    total = 0
+    with open(out_file, 'w') as f:
+        for input_file in input_files:
+            file_total = 0
+            for data_dict in read_jsonl(input_file):
+                total += 1
+                file_total += 1
+                key = request_hash(data_dict['body'])
+                if key in seen:
+                    continue
+                seen.add(key)
+                unique_dict = dict(data_dict)
+                unique_dict['custom_id'] = key
+                f.write(json.dumps(unique_dict) + '\n')
+            print(f"{input_file}: {file_total} requests")
+
+    saved = total - len(seen)
+    print(f"Total requests: {total}")
+    print(f"Unique requests: {len(seen)}")
+    print(f"Saved calls: {saved} ({100 * saved / max(total, 1):.1f}%)")
+
+
+def fanout(input_files, responses_file, output_dir):
+    """
+    Copies each deduplicated response back to every original request,
+    writing `<input file>_outputs.jsonl` per input file in its original order.
+    Requests without a response go to `<input file>_outputs.jsonl.dead_letter.jsonl`
+    instead, as in parallel_call.py.
+    """
+    responses = dict()
+    for result in read_jsonl(responses_file):
+        responses[result['custom_id']] = result
+
+    for input_file in input_files:
+        out_file = output_file_for(input_file, output_dir)
+        dead_letter_file = f"{out_file}.dead_letter.jsonl"
+        missing = 0
+        with open(out_file, 'w') as f, open(dead_letter_file, 'w') as dead_letter:
+            for data_dict in read_jsonl(input_file):
+                custom_id = data_dict['custom_id']
+                result = responses.get(request_hash(data_dict['body']))
+                if result is None:
+                    missing += 1
+                    result = {'error': 'No response for deduplicated request', 'error_type': 'MissingResponse'}
+                    dead_letter.write(json.dumps(dead_letter_entry(data_dict, result)) + '\n')
+                    continue
+                result = dict(result)
+                result['custom_id'] = custom_id
+                f.write(json.dumps(result) + '\n')
+        if missing:
+            print(f"Wrote {out_file}, {missing} requests without a response are in {dead_letter_file}")
+        else:
+            os.remove(dead_letter_file)
+            print(f"Wrote {out_file}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Deduplicate identical requests across evaluation files')
+    parser.add_argument('--plan', action="store_true", help='Write the unique requests of all input files to --out_file')
+    parser.add_argument('--fanout', action="store_true", help='Copy responses for the unique requests back to every input file')
+    parser.add_argument('--input_files', type=str, nargs='+', help='Evaluation JSONL files generated by llm_evaluators')
+    parser.add_argument('--out_file', type=str, help='Unique requests to dispatch (--plan)')
+    parser.add_argument('--responses_file', type=str, help='Outputs of dispatching --out_file (--fanout)')
+    parser.add_argument('--output_dir', type=str, default=None, help='Directory for the per-file outputs (default: next to each input file)')
+    return parser.parse_args()
+
+def main(args):
+    if args.plan:
+        plan(args.input_files, args.out_file)
+    elif args.fanout:
+        fanout(args.input_files, args.responses_file, args.output_dir)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -1,40 +1,76 @@
 import os
-import json
+import shutil
 import argparse
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+from batch_call import get_batch_client, download_file
+from job_store import JobStore
 
-API_KEY = os.environ['OPENAI_API_KEY']
-client = OpenAI(api_key=API_KEY)
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Batch processing')
-    parser.add_argument('--file_name', type=str, help='File name of batch job')
+    parser.add_argument('--job_store', type=str, default='jobs.sqlite', help='Job store written by batch_call.py')
+    parser.add_argument('--job_name', type=str, default=None, help='Only download this job')
     parser.add_argument('--data_path', type=str, default='/Users/sumanth/code/fbi/data', help='Path to data directory')
+    parser.add_argument('--n_workers', type=int, default=8, help='Number of batch outputs to download at the same time')
     args = parser.parse_args()
     return args
 
+def download_batch(batch_id, file_name):
+    """
+    Streams the output of a batch to `file_name` and checks that it has one
+    line per completed request. Returns (lines, expected lines).
+    """
+    status = get_batch_client().batches.retrieve(batch_id)
+    if status.output_file_id is None:
+        raise ValueError(f"Batch {batch_id} has no output file (status: {status.status})")
+    lines = download_file(status.output_file_id, file_name)
+    return lines, status.request_counts.completed
+
 def main(args):
-    #read the batch list from the file
-    with open(f"{args.file_name}", "r") as f:
-        batch_list = json.load(f)
-        
-    #for each batch, fetch the status object
-    for batch in batch_list:
-        print(f"Collecting {batch['file_name']}_answers.jsonl")
-        status = client.batches.retrieve(batch['batch_id']).to_dict()
-        output_file_id = status['output_file_id']
-        content = client.files.content(output_file_id)
-        jsonl_lines = content.content.decode("utf-8").splitlines()
+    store = JobStore(args.job_store)
+
+    #download every batch of every job concurrently, each into its own part file
+    #(named after the batch, as jobs may share an input file and data path)
+    jobs = []
+    with ThreadPoolExecutor(max_workers=args.n_workers) as executor:
+        for job in store.jobs():
+            if args.job_name not in (None, job['job_name']):
+                continue
+            dir = os.path.join(args.data_path, job['path'] or '')
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+            output_file = f"{dir}/{job['input_file']}_outputs.jsonl"
+            parts = [(batch['batch_id'], f"{output_file}.{batch['batch_id']}.part") for batch in store.batches(job['job_name'])]
+            futures = [executor.submit(download_batch, batch_id, part_file) for batch_id, part_file in parts]
+            jobs.append((output_file, parts, futures))
 
-        dir = os.path.join(args.data_path, batch['path'])
-        if not os.path.exists(dir):
-            os.makedirs(dir)
+        failed = 0
+        for output_file, parts, futures in jobs:
+            print(f"Collecting {os.path.basename(output_file)}")
+            try:
+                counts = [future.result() for future in futures]
+            except Exception as e:
+                print(f"    failed: {e}")
+                for _, part_file in parts:
+                    if os.path.exists(part_file):
+                        os.remove(part_file)
+                failed += 1
+                continue
+            for (batch_id, _), (lines, expected) in zip(parts, counts):
+                if lines != expected:
+                    print(f"    batch {batch_id}: {lines} lines but {expected} completed requests")
+            if len(parts) == 1:
+                os.replace(parts[0][1], output_file)
+            else:
+                with open(output_file, 'wb') as out:
+                    for _, part_file in parts:
+                        with open(part_file, 'rb') as f:
+                            shutil.copyfileobj(f, out)
+                        os.remove(part_file)
+    if failed:
+        print(f"{failed} of {len(jobs)} jobs could not be downloaded")
+    store.close()
 
-        with open(f"{dir}/{batch['file_name']}_outputs.jsonl", "w") as f:
-            for line in jsonl_lines:
-                json_obj = json.loads(line)
-                f.write(json.dumps(json_obj) + "\n")
-        
 if __name__ == '__main__':
     args = parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -1,36 +1,46 @@
 import os
-import json
 import argparse
-from openai import OpenAI
-
-API_KEY = os.environ['OPENAI_API_KEY']
-client = OpenAI(api_key=API_KEY)
+from batch_call import FINAL_STATES, get_batch_client, download_file
+from job_store import JobStore
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Batch processing')
-    parser.add_argument('--file_name', type=str, help='File name of batch job')
+    parser.add_argument('--job_store', type=str, default='jobs.sqlite', help='Job store written by batch_call.py')
     parser.add_argument('--data_path', type=str, default='/Users/sumanth/code/fbi/data', help='Path to data directory')
     args = parser.parse_args()
     return args
 
 def main(args):
-    #read the batch list from the file
-    with open(f"{args.file_name}", "r") as f:
-        batch_list = json.load(f)
-        
-    #for each batch, fetch the status object
-    for batch in batch_list:
-        print(f"Collecting {batch['input_file']}_answers.jsonl")
-        status = client.batches.retrieve(batch['batch_id']).to_dict()
-        output_file_id = status['output_file_id']
-        content = client.files.content(output_file_id)
-        jsonl_lines = content.content.decode("utf-8").splitlines()
+    store = JobStore(args.job_store)
 
-        with open(f"{args.data_path}/{batch['input_file']}_answers.jsonl", "w") as f:
-            for line in jsonl_lines:
-                json_obj = json.loads(line)
-                f.write(json.dumps(json_obj) + "\n")
+    #for each finished job, fetch the output of each of its batches
+    for job in store.jobs():
+        answers_file = f"{args.data_path}/{job['input_file']}_answers.jsonl"
+        batches = store.batches(job['job_name'])
+        statuses = [get_batch_client().batches.retrieve(batch['batch_id']).to_dict() for batch in batches]
+        unfinished = [status['id'] for status in statuses if status['status'] not in FINAL_STATES]
+        if unfinished:
+            print(f"Skipping {job['job_name']}, {len(unfinished)} batches are not finished: {', '.join(unfinished)}")
+            continue
+        print(f"Collecting {job['input_file']}_answers.jsonl")
+        missing = []
+        #the answers file is only replaced once every output is downloaded
+        with open(f"{answers_file}.tmp", "wb") as f:
+            for batch, status in zip(batches, statuses):
+                #a failed batch has no output file
+                if status.get('output_file_id') is None:
+                    missing.append(f"{batch['batch_id']} ({status['status']})")
+                    continue
+                part_file = f"{answers_file}.{batch['batch_id']}.part"
+                download_file(status['output_file_id'], part_file)
+                with open(part_file, 'rb') as part:
+                    f.writelines(part)
+                os.remove(part_file)
+        os.replace(f"{answers_file}.tmp", answers_file)
+        if missing:
+            print(f"    {len(missing)} batches have no output file: {', '.join(missing)}")
+    store.close()
         
 if __name__ == '__main__':
     args = parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
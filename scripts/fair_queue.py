@@ -0,0 +1,116 @@
+import time
+import asyncio
+import collections
+
+
+class Job:
+    """
+    One input file of a run: its requests, where their results go, and how
+    it shares the providers with the other jobs of the run. Waiting requests
+    of a job with a higher `priority` always go first; jobs of equal
+    priority share by `weight`.
+
+    `writer` and `dead_letter` are set once the output files are open.
+    """
+
+    def __init__(self, idx, input_file_name, data, output_file_name, dead_letter_file, total=None, append=False,
+                 weight=1.0, priority=0):
+        self.idx = idx
+        self.input_file_name = input_file_name
+        self.data = data
+        self.output_file_name = output_file_name
+        self.dead_letter_file = dead_letter_file
+        self.total = total
+        self.append = append
+        self.weight = weight
+        self.priority = priority
+        self.writer = None
+        self.dead_letter = None
+        self.results = 0
+        self.finished_at = None
+
+    def on_result(self):
+        self.results += 1
+        self.finished_at = time.monotonic()
+
+
+class FairScheduler:
+    """
+    Start-time fair queuing across jobs. Each job has a virtual time that
+    advances by cost / weight for every request it sends, and the next
+    request comes from the highest-priority waiting job with the lowest
+    virtual time, so jobs of equal priority get throughput in proportion to
+    their weights. A job that was idle resumes at the current virtual time
+    instead of with credit for the time it sat out.
+    """
+
+    def __init__(self):
+        self.virtual_time = 0.0
+        self.tags = dict()
+
+    def start_tag(self, job):
+        return max(self.tags.get(job, 0.0), self.virtual_time)
+
+    def pick(self, jobs):
+        return min(jobs, key=lambda job: (-job.priority, self.start_tag(job), job.idx))
+
+    def charge(self, job, cost=1.0):
+        start = self.start_tag(job)
+        self.virtual_time = start
+        self.tags[job] = start + cost / job.weight
+
+
+class FairQueue:
+    """
+    Takes the place of an asyncio.Queue of one provider's requests: items
+    wait per job and `get` returns the one the scheduler picks rather than
+    the oldest. After `close(n_getters)`, once the queue is empty, `get`
+    returns None once for each getter.
+    """
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler or FairScheduler()
+        self.waiting = dict()
+        self.available = asyncio.Semaphore(0)
+
+    def put_nowait(self, job, item, cost=1.0):
+        self.waiting.setdefault(job, collections.deque()).append((item, cost))
+        self.available.release()
+
+    def close(self, n_getters):
+        for _ in range(n_getters):
+            self.available.release()
+
+    async def get(self):
+        await self.available.acquire()
+        jobs = [job for job, items in self.waiting.items() if items]
+        if not jobs:
+            return None
+        job = self.scheduler.pick(jobs)
+        item, cost = self.waiting[job].popleft()
+        self.scheduler.charge(job, cost)
+        return item
+
+
+def interleave(jobs, cost_fn, scheduler=None):
+    """
+    Yields (job, request) from all jobs, choosing the job of each next
+    request with the scheduler. Each job's requests keep their order.
+    """
+    scheduler = scheduler or FairScheduler()
+    iterators = {job: iter(job.data) for job in jobs}
+    heads = dict()
+    for job, iterator in iterators.items():
+        data_dict = next(iterator, None)
+        if data_dict is not None:
+            heads[job] = data_dict
+    while heads:
+        job = scheduler.pick(list(heads))
+        data_dict = heads[job]
+        scheduler.charge(job, cost_fn(data_dict))
+        next_dict = next(iterators[job], None)
+        if next_dict is None:
+            del heads[job]
+        else:
+            heads[job] = next_dict
+        yield job, data_dict
@@ -0,0 +1,83 @@
+import time
+import asyncio
+import logging
+import collections
+from request_metrics import percentile
+
+
+logger = logging.getLogger()
+
+
+class LatencyTracker:
+    """
+    Latencies of the last `window` finished requests of one provider. The
+    hedge delay is their `q`-th percentile, once `min_samples` are in.
+    """
+
+    def __init__(self, q=95, window=1000, min_samples=20):
+        self.q = q
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=window)
+
+    def record(self, latency):
+        self.latencies.append(latency)
+
+    def hedge_delay(self):
+        if len(self.latencies) < self.min_samples:
+            return None
+        return percentile(list(self.latencies), self.q)
+
+
+class HedgeBudget:
+    """
+    Allows at most `fraction` extra requests: a hedge may only be sent while
+    hedges so far stay within `fraction` of the requests started.
+    """
+
+    def __init__(self, fraction=0.05):
+        self.fraction = fraction
+        self.started = 0
+        self.hedges = 0
+
+    def on_request(self):
+        self.started += 1
+
+    def try_spend(self):
+        if self.hedges + 1 > self.fraction * self.started:
+            return False
+        self.hedges += 1
+        return True
+
+
+async def hedged(make_attempt, tracker, budget, name=''):
+    """
+    Awaits `make_attempt()`; if it has not finished after the tracker's hedge
+    delay and the budget allows, starts a second `make_attempt()`. The first
+    successful result wins and the other attempt is cancelled; an error
+    result is only returned once both attempts have failed. Returns
+    (result, hedged).
+    """
+    budget.on_request()
+    start = time.monotonic()
+    tasks = [asyncio.ensure_future(make_attempt())]
+    delay = tracker.hedge_delay()
+    result = None
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and budget.try_spend():
+                logger.debug(f"[{name}] hedging a request after {delay:.2f}s")
+                tasks.append(asyncio.ensure_future(make_attempt()))
+        pending = set(tasks)
+        while pending and (result is None or result.get('error') is not None):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            #tasks are in start order, so the primary wins a tie
+            for task in tasks:
+                if task in done and (result is None or result.get('error') is not None):
+                    result = task.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    tracker.record(time.monotonic() - start)
+    return result, len(tasks) > 1
@@ -0,0 +1,242 @@
+import os
+import sys
+import time
+import shlex
+import argparse
+import subprocess
+from types import SimpleNamespace
+import batch_call
+from dashboard import format_duration
+from job_store import JobStore
+from jsonl_stream import read_jsonl
+from merge_shards import merge_shards, print_report
+from parallel_call import get_provider
+from rate_limiter import estimate_tokens
+from request_metrics import estimate_cost
+
+
+# The Batch API bills half the list price
+BATCH_DISCOUNT = 0.5
+# Completion tokens assumed for requests without max_tokens
+DEFAULT_COMPLETION_TOKENS = 512
+
+
+class Chunk:
+    """
+    `requests` consecutive requests of one input file, their estimated cost
+    at list price, and whether the Batch API can take all of them (only
+    OpenAI chat models can). `route` is set by `plan`.
+    """
+
+    def __init__(self, file_idx, chunk_idx):
+        self.file_idx = file_idx
+        self.chunk_idx = chunk_idx
+        self.requests = 0
+        self.cost = 0.0
+        self.batchable = True
+        self.route = None
+
+    def add(self, body, unknown_models):
+        self.requests += 1
+        completion_tokens = body.get('max_tokens') or DEFAULT_COMPLETION_TOKENS
+        prompt_tokens = estimate_tokens(body) - body.get('max_tokens', 0)
+        cost = estimate_cost(body['model'], prompt_tokens, completion_tokens)
+        if cost is None:
+            unknown_models.add(body['model'])
+        self.cost += cost or 0.0
+        self.batchable = self.batchable and get_provider(body['model']) == 'openai'
+
+    def route_cost(self, route, batch_discount=BATCH_DISCOUNT):
+        return self.cost * (1 - batch_discount) if route == 'batch' else self.cost
+
+
+def scan_chunks(file_idx, input_file_name, chunk_requests, unknown_models):
+    """Streams an input file into chunks of at most `chunk_requests` requests."""
+    chunks = []
+    for request_idx, data_dict in enumerate(read_jsonl(input_file_name)):
+        if request_idx % chunk_requests == 0:
+            chunks.append(Chunk(file_idx, len(chunks)))
+        chunks[-1].add(data_dict['body'], unknown_models)
+    return chunks
+
+
+def plan(chunks, deadline=None, budget=None, batch_turnaround=86400, realtime_rps=5.0, batch_discount=BATCH_DISCOUNT):
+    """
+    Routes each chunk to 'batch' or 'realtime'. When the Batch API's
+    turnaround fits the deadline (or there is none), every chunk it can take
+    goes there, as it is the cheapest. Otherwise chunks go realtime in input
+    order for as long as `realtime_rps` finishes them before the deadline and
+    their cost fits the budget; the rest go to the Batch API and will be
+    late. Chunks the Batch API cannot take always go realtime.
+    """
+    batch_in_time = deadline is None or batch_turnaround <= deadline
+    realtime_requests = 0
+    cost = 0.0
+    for chunk in chunks:
+        if not chunk.batchable:
+            chunk.route = 'realtime'
+            realtime_requests += chunk.requests
+            cost += chunk.cost
+    for chunk in chunks:
+        if not chunk.batchable:
+            continue
+        in_time = not batch_in_time and (realtime_requests + chunk.requests) / realtime_rps <= deadline
+        affordable = budget is None or cost + chunk.cost <= budget
+        chunk.route = 'realtime' if in_time and affordable else 'batch'
+        if chunk.route == 'realtime':
+            realtime_requests += chunk.requests
+        cost += chunk.route_cost(chunk.route, batch_discount)
+
+
+def print_plan(input_files, chunks, deadline=None, budget=None, batch_turnaround=86400, realtime_rps=5.0,
+               batch_discount=BATCH_DISCOUNT, unknown_models=()):
+    """Prints the routes, estimated cost and finish time of a plan; returns False if it misses the deadline or budget."""
+    ok = True
+    for file_idx, input_file_name in enumerate(input_files):
+        file_chunks = [chunk for chunk in chunks if chunk.file_idx == file_idx]
+        routes = dict()
+        for chunk in file_chunks:
+            requests, cost = routes.get(chunk.route, (0, 0.0))
+            routes[chunk.route] = (requests + chunk.requests, cost + chunk.route_cost(chunk.route, batch_discount))
+        route_text = ', '.join(f"{route}: {requests} requests (${cost:.2f})" for route, (requests, cost) in sorted(routes.items()))
+        print(f"{input_file_name}: {len(file_chunks)} chunks, {route_text}")
+
+    realtime_requests = sum(chunk.requests for chunk in chunks if chunk.route == 'realtime')
+    finish = realtime_requests / realtime_rps
+    if any(chunk.route == 'batch' for chunk in chunks):
+        finish = max(finish, batch_turnaround)
+    cost = sum(chunk.route_cost(chunk.route, batch_discount) for chunk in chunks)
+    print(f"Estimated cost: ${cost:.2f} (${sum(chunk.cost for chunk in chunks):.2f} all realtime), "
+          f"estimated to finish in {format_duration(finish)}")
+    if unknown_models:
+        print(f"No pricing for {', '.join(sorted(unknown_models))}, counted as free")
+    if deadline is not None and finish > deadline:
+        print(f"Misses the deadline of {format_duration(deadline)}")
+        ok = False
+    if budget is not None and cost > budget:
+        print(f"Over the budget of ${budget:.2f}")
+        ok = False
+    return ok
+
+
+def split_routes(input_file_name, chunks, chunk_requests, realtime_file_name, batch_file_name):
+    """Copies the lines of each chunk to the input file of its route. Returns the requests in each."""
+    counts = {'realtime': 0, 'batch': 0}
+    with open(input_file_name, 'rb') as f, open(realtime_file_name, 'wb') as realtime, open(batch_file_name, 'wb') as batch:
+        request_idx = 0
+        for line in f:
+            if not line.strip():
+                continue
+            route = chunks[request_idx // chunk_requests].route
+            (realtime if route == 'realtime' else batch).write(line if line.endswith(b'\n') else line + b'\n')
+            counts[route] += 1
+            request_idx += 1
+    return counts
+
+
+def run(args, chunks):
+    """
+    Submits the batch chunks of every file first, so the Batch API works on
+    them while the realtime chunks go through parallel_call.py, then waits
+    for the batches and merges both halves of each file into its output
+    file in input order. Requests without a result are written to
+    OUTPUT.gaps.jsonl.
+    """
+    started_at = time.monotonic()
+    store = JobStore(args.job_store)
+    files = []
+    for file_idx, (input_file_name, output_file_name) in enumerate(zip(args.input_file_name, args.output_file_name)):
+        realtime_input = f"{output_file_name}.realtime_input.jsonl"
+        batch_input = f"{output_file_name}.batch_input.jsonl"
+        counts = split_routes(input_file_name, [chunk for chunk in chunks if chunk.file_idx == file_idx],
+                              args.chunk_requests, realtime_input, batch_input)
+        if not counts['realtime']:
+            os.remove(realtime_input)
+            realtime_input = None
+        job_name = None
+        if counts['batch']:
+            job_name = f"{os.path.basename(output_file_name)}-{time.strftime('%Y%m%d-%H%M%S')}"
+            batch_call.create_batches(SimpleNamespace(job_name=job_name, input_file_name=os.path.basename(batch_input),
+                                                      data_path=os.path.dirname(os.path.abspath(batch_input)), job_desc=args.job_desc,
+                                                      max_batch_requests=args.max_batch_requests, max_batch_mb=args.max_batch_mb), store)
+        else:
+            os.remove(batch_input)
+            batch_input = None
+        files.append((input_file_name, output_file_name, realtime_input, batch_input, job_name))
+
+    realtime = [(realtime_input, f"{output_file_name}.realtime.jsonl") for _, output_file_name, realtime_input, _, _ in files if realtime_input]
+    if realtime:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parallel_call.py'),
+                   '--input_file_name', *[pair[0] for pair in realtime], '--output_file_name', *[pair[1] for pair in realtime]]
+        if args.deadline is not None:
+            command += ['--deadline', str(max(0.0, args.deadline - (time.monotonic() - started_at)))]
+        subprocess.run(command + shlex.split(args.realtime_args), check=True)
+
+    failed = 0
+    for input_file_name, output_file_name, realtime_input, batch_input, job_name in files:
+        shard_files = []
+        if realtime_input:
+            shard_files.append(f"{output_file_name}.realtime.jsonl")
+        if job_name:
+            batch_call.watch(SimpleNamespace(job_name=job_name, data_path=os.path.dirname(os.path.abspath(batch_input)),
+                                             poll_interval=args.poll_interval, max_poll_interval=args.max_poll_interval,
+                                             analyze_type=None, num_axes=None), store)
+            shard_files.append(store.get_job(job_name)['output_file'])
+        print(f"Merging {output_file_name}")
+        merged, gaps, duplicates, unknown, unreadable = merge_shards(input_file_name, shard_files, output_file_name,
+                                                                     f"{output_file_name}.gaps.jsonl")
+        print_report(merged, gaps, duplicates, unknown, unreadable)
+        failed += len(gaps)
+        for file_name in [realtime_input, batch_input] + shard_files:
+            if file_name and os.path.exists(file_name):
+                os.remove(file_name)
+    store.close()
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Dispatch evaluator files through the Batch API or parallel_call.py, chunk by chunk, to meet a deadline within a budget')
+    parser.add_argument('--input_file_name', type=str, nargs='+', required=True, help='Evaluator JSONL files')
+    parser.add_argument('--output_file_name', type=str, nargs='+', required=True, help='Output file name, one per input file')
+    parser.add_argument('--deadline', type=float, default=None, help='Seconds by which all results are wanted; without one everything the Batch API can take goes there')
+    parser.add_argument('--budget', type=float, default=None, help='Maximum estimated cost in USD')
+    parser.add_argument('--chunk_requests', type=int, default=5000, help='Requests per chunk; each chunk is routed as a whole')
+    parser.add_argument('--batch_turnaround', type=float, default=86400, help='Seconds a batch is expected to take (the completion window is 24h)')
+    parser.add_argument('--realtime_rps', type=float, default=5.0, help='Requests/s expected from parallel_call.py, e.g. requests_per_s from an earlier run\'s metrics summary')
+    parser.add_argument('--batch_discount', type=float, default=BATCH_DISCOUNT, help='Discount of the Batch API over list price')
+    parser.add_argument('--realtime_args', type=str, default='', help='Extra arguments for parallel_call.py, e.g. "--async_mode --max_concurrency 64"')
+    parser.add_argument('--job_desc', type=str, default='hybrid_call.py', help='Description of the batch jobs')
+    parser.add_argument('--job_store', type=str, default='jobs.sqlite', help='Job store that records the batches of each job')
+    parser.add_argument('--max_batch_requests', type=int, default=batch_call.MAX_BATCH_REQUESTS, help='Split batch inputs into batches of at most this many requests')
+    parser.add_argument('--max_batch_mb', type=float, default=batch_call.MAX_BATCH_MB, help='Split batch inputs into files of at most this many MB')
+    parser.add_argument('--poll_interval', type=float, default=30, help='Seconds between polls of the batches')
+    parser.add_argument('--max_poll_interval', type=float, default=600, help='Longest wait between polls of the batches')
+    parser.add_argument('--dry_run', action='store_true', help='Only print the plan')
+    parser.add_argument('--force', action='store_true', help='Run a plan that misses the deadline or budget')
+    args = parser.parse_args()
+    if len(args.input_file_name) != len(args.output_file_name):
+        parser.error("--output_file_name needs one file per --input_file_name")
+    return args
+
+def main(args):
+    unknown_models = set()
+    chunks = []
+    for file_idx, input_file_name in enumerate(args.input_file_name):
+        chunks.extend(scan_chunks(file_idx, input_file_name, args.chunk_requests, unknown_models))
+    plan(chunks, args.deadline, args.budget, args.batch_turnaround, args.realtime_rps, args.batch_discount)
+    ok = print_plan(args.input_file_name, chunks, args.deadline, args.budget, args.batch_turnaround, args.realtime_rps,
+                    args.batch_discount, unknown_models)
+    if args.dry_run:
+        return 0
+    if not ok and not args.force:
+        print("Not running; raise --deadline or --budget, or pass --force")
+        return 1
+    failed = run(args, chunks)
+    if failed:
+        print(f"{failed} requests have no result, see the .gaps.jsonl files")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    sys.exit(main(args))
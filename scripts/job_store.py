@@ -0,0 +1,166 @@
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_name TEXT PRIMARY KEY,
+    input_file TEXT NOT NULL,
+    path TEXT,
+    data_path TEXT,
+    description TEXT,
+    output_file TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    job_name TEXT NOT NULL REFERENCES jobs(job_name),
+    chunk_idx INTEGER NOT NULL,
+    first_request INTEGER,
+    requests INTEGER,
+    bytes INTEGER,
+    status TEXT,
+    output_file_id TEXT,
+    error_file_id TEXT,
+    output_file TEXT,
+    error_file TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (job_name, chunk_idx)
+);
+CREATE INDEX IF NOT EXISTS batches_status ON batches(status);
+CREATE INDEX IF NOT EXISTS jobs_unfinished ON jobs(finished_at);
+"""
+
+BATCH_FIELDS = {'status', 'output_file_id', 'error_file_id', 'output_file', 'error_file'}
+
+
+class JobStore:
+    """
+    SQLite store of Batch API jobs shared by batch_call.py, download.py and
+    download_batch_outputs.py. A job is one input file; it has one batch per
+    chunk the input was split into. Every write is its own transaction, and
+    several processes can submit and watch jobs in the same store at once.
+    """
+
+    def __init__(self, db_file='jobs.sqlite'):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        #readers do not block the writer and vice versa
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def create_job(self, job_name, input_file, path=None, data_path=None, description=None):
+        try:
+            with self.lock, self.conn:
+                self.conn.execute('INSERT INTO jobs (job_name, input_file, path, data_path, description, created_at) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)', (job_name, input_file, path, data_path, description, time.time()))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"{self.db_file} already has a job named {job_name}")
+
+    def add_batch(self, job_name, chunk_idx, batch_id, first_request=None, requests=None, bytes=None, status=None):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('INSERT INTO batches (batch_id, job_name, chunk_idx, first_request, requests, bytes, status, created_at, updated_at) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (batch_id, job_name, chunk_idx, first_request, requests, bytes, status, now, now))
+
+    def update_batch(self, batch_id, **fields):
+        unknown = set(fields) - BATCH_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown batch fields: {', '.join(sorted(unknown))}")
+        columns = ', '.join(f"{field} = ?" for field in fields)
+        with self.lock, self.conn:
+            self.conn.execute(f'UPDATE batches SET {columns}, updated_at = ? WHERE batch_id = ?',
+                              (*fields.values(), time.time(), batch_id))
+
+    def finish_job(self, job_name, output_file):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE jobs SET output_file = ?, finished_at = ? WHERE job_name = ?',
+                              (output_file, time.time(), job_name))
+
+    def get_job(self, job_name):
+        jobs = self._query('SELECT * FROM jobs WHERE job_name = ?', (job_name,))
+        return jobs[0] if jobs else None
+
+    def get_batch(self, batch_id):
+        batches = self._query('SELECT * FROM batches WHERE batch_id = ?', (batch_id,))
+        return batches[0] if batches else None
+
+    def jobs(self, unfinished=False):
+        if unfinished:
+            return self._query('SELECT * FROM jobs WHERE finished_at IS NULL ORDER BY created_at')
+        return self._query('SELECT * FROM jobs ORDER BY created_at')
+
+    def batches(self, job_name):
+        return self._query('SELECT * FROM batches WHERE job_name = ? ORDER BY chunk_idx', (job_name,))
+
+    def import_tracking(self, tracking_file):
+        """
+        Adds the jobs of a tracking.json. Entries with a single `batch_id`
+        (the input under `file_name` or `input_file`) become one-batch jobs
+        named after their batch. Each job is added in one transaction, and
+        jobs already in the store are skipped. Returns the number added.
+        """
+        with open(tracking_file) as f:
+            entries = json.load(f)
+        added = 0
+        for entry in entries:
+            batches = entry.get('batches') or [{'batch_id': entry['batch_id']}]
+            job_name = entry.get('job_name', batches[0]['batch_id'])
+            if self.get_job(job_name) is not None:
+                continue
+            now = time.time()
+            with self.lock, self.conn:
+                self.conn.execute('INSERT INTO jobs (job_name, input_file, path, data_path, output_file, created_at, finished_at) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (job_name, entry.get('file_name', entry.get('input_file')), entry.get('path'), entry.get('data_path'),
+                                   entry.get('output_file'), now, now if entry.get('output_file') else None))
+                for chunk_idx, batch in enumerate(batches):
+                    self.conn.execute('INSERT INTO batches (batch_id, job_name, chunk_idx, first_request, requests, bytes, status, created_at, updated_at) '
+                                      'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (batch['batch_id'], job_name, chunk_idx, batch.get('first_request'), batch.get('requests'),
+                                       batch.get('bytes'), batch.get('status'), now, now))
+            added += 1
+        return added
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Inspect the job store of batch_call.py')
+    parser.add_argument('--job_store', type=str, default='jobs.sqlite', help='Job store file')
+    parser.add_argument('--import_tracking', type=str, default=None, help='Import the jobs of an old tracking.json')
+    parser.add_argument('--list', action='store_true', help='List the jobs and the states of their batches')
+    return parser.parse_args()
+
+def main(args):
+    store = JobStore(args.job_store)
+    if args.import_tracking:
+        print(f"Imported {store.import_tracking(args.import_tracking)} jobs from {args.import_tracking}")
+    if args.list:
+        for job in store.jobs():
+            states = dict()
+            for batch in store.batches(job['job_name']):
+                states[batch['status']] = states.get(batch['status'], 0) + 1
+            state_text = ', '.join(f"{n} {state or 'unknown'}" for state, n in states.items())
+            print(f"{job['job_name']}: {job['input_file']}, {state_text}, {job['output_file'] or 'not downloaded'}")
+    store.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,51 @@
+import json
+
+
+def read_jsonl(file_name):
+    """
+    Yields one parsed object per line, so only the current line is held in
+    memory. Blank lines (e.g. a trailing newline) are skipped.
+    """
+    with open(file_name) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def count_lines(file_name, chunk_size=1 << 20):
+    """
+    Counts the lines of a file in fixed-size binary chunks, without decoding
+    or parsing them. A final line without a trailing newline is counted too.
+    """
+    n_lines = 0
+    last_chunk = b'\n'
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            n_lines += chunk.count(b'\n')
+            last_chunk = chunk
+    if not last_chunk.endswith(b'\n'):
+        n_lines += 1
+    return n_lines
+
+
+class JsonlFile:
+    """
+    A JSONL file that can be iterated lazily, any number of times, in place
+    of a list of its parsed lines. `len()` is the number of lines, counted
+    once without parsing them.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.n_lines = None
+
+    def __iter__(self):
+        return read_jsonl(self.file_name)
+
+    def __len__(self):
+        if self.n_lines is None:
+            self.n_lines = count_lines(self.file_name)
+        return self.n_lines
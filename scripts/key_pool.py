@@ -0,0 +1,161 @@
+import os
+import time
+import logging
+import threading
+from provider_config import get_provider_setting
+
+
+logger = logging.getLogger()
+
+# Environment variable prefix of each provider's keys: <PREFIX>_API_KEY holds
+# one key, <PREFIX>_API_KEYS a comma-separated pool.
+ENV_PREFIXES = {
+    'openai': 'OPENAI',
+    'llama3': 'LLAMA3',
+    'claude': 'CLAUDE',
+    'gemini': 'GEMINI'
+}
+
+KEY_STRATEGIES = ['round_robin', 'least_loaded']
+DEFAULT_KEY_COOLDOWN = 10.0
+
+# Shared pools by provider, and the settings they are built from.
+_KEY_POOLS = dict()
+_KEY_POOLS_LOCK = threading.Lock()
+_KEY_POOL_CONFIG = dict()
+
+
+class ApiKey:
+    """
+    One key of a pool. `label` names it in logs without revealing it, and
+    `rpm`/`tpm` override the provider's per-key quota when set.
+    """
+
+    def __init__(self, value, label, rpm=None, tpm=None):
+        self.value = value
+        self.label = label
+        self.rpm = rpm
+        self.tpm = tpm
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.cooldown_until = 0.0
+
+
+class KeyPool:
+    """
+    Hands out a provider's API keys, round-robin or to the key with the
+    fewest requests in flight. A key that gets a 429 sits out for the
+    provider's Retry-After, or `cooldown` seconds without one, while the
+    other keys take its requests. If every key is cooling down, the one that
+    comes back first is used.
+    """
+
+    def __init__(self, name, keys, strategy='round_robin', cooldown=DEFAULT_KEY_COOLDOWN):
+        if strategy not in KEY_STRATEGIES:
+            raise ValueError(f"Unknown key strategy: {strategy}")
+        self.name = name
+        self.keys = keys
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.next_idx = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Picks a key for one attempt; pass it back to `release` afterwards."""
+        with self.lock:
+            now = time.monotonic()
+            available = [key for key in self.keys if key.cooldown_until <= now]
+            if not available:
+                key = min(self.keys, key=lambda key: key.cooldown_until)
+            elif self.strategy == 'least_loaded':
+                key = min(available, key=lambda key: (key.in_flight, key.requests))
+            else:
+                #the first available key at or after the cursor
+                n_keys = len(self.keys)
+                order = [self.keys[(self.next_idx + i) % n_keys] for i in range(n_keys)]
+                key = next(key for key in order if key.cooldown_until <= now)
+                self.next_idx = (self.keys.index(key) + 1) % n_keys
+            key.in_flight += 1
+            key.requests += 1
+            return key
+
+    def release(self, key, rate_limited=False, retry_after=None):
+        with self.lock:
+            key.in_flight -= 1
+            if rate_limited:
+                key.rate_limited += 1
+                if len(self.keys) > 1:
+                    cooldown = retry_after if retry_after is not None else self.cooldown
+                    key.cooldown_until = max(key.cooldown_until, time.monotonic() + cooldown)
+                    logger.debug(f"[{self.name}] key {key.label} rate-limited, rotating it out for {cooldown:.0f}s")
+
+    def summary(self):
+        return {key.label: {'requests': key.requests, 'rate_limited': key.rate_limited} for key in self.keys}
+
+
+def configure_key_pools(config, strategy='round_robin', cooldown=DEFAULT_KEY_COOLDOWN):
+    """
+    Sets the settings used by `get_key_pool`. `config` is a provider config
+    (see provider_config.py) whose "key_strategy"/"key_cooldown" settings
+    override the defaults and whose "api_keys" list overrides the keys
+    found in the environment.
+    """
+    _KEY_POOL_CONFIG.clear()
+    _KEY_POOL_CONFIG.update({
+        'config': config,
+        'strategy': strategy,
+        'cooldown': cooldown
+    })
+    _KEY_POOLS.clear()
+
+
+def load_keys(provider, config):
+    """
+    Returns the ApiKeys of a provider. Entries of "api_keys" in the provider
+    config name the environment variable holding each key, optionally with
+    its own quota, e.g. ["OPENAI_KEY_A", {"env": "OPENAI_KEY_B", "rpm": 500}].
+    Otherwise <PREFIX>_API_KEYS (comma-separated) or <PREFIX>_API_KEY is used.
+    """
+    entries = config.get(provider, {}).get('api_keys')
+    if entries:
+        keys = []
+        for entry in entries:
+            if isinstance(entry, str):
+                entry = {'env': entry}
+            value = os.getenv(entry['env'])
+            if not value:
+                raise ValueError(f"Environment variable {entry['env']} of the {provider} key pool is not set")
+            keys.append(ApiKey(value, entry['env'], entry.get('rpm'), entry.get('tpm')))
+        return keys
+
+    prefix = ENV_PREFIXES.get(provider, provider.upper())
+    pool = os.getenv(f'{prefix}_API_KEYS')
+    if pool:
+        values = [value.strip() for value in pool.split(',') if value.strip()]
+        return [ApiKey(value, f'{prefix}_API_KEYS[{i}]') for i, value in enumerate(values)]
+    return [ApiKey(os.getenv(f'{prefix}_API_KEY'), f'{prefix}_API_KEY')]
+
+
+def get_key_pool(provider):
+    """Returns the shared key pool of a provider."""
+    if provider in _KEY_POOLS:
+        return _KEY_POOLS[provider]
+
+    with _KEY_POOLS_LOCK:
+        if provider not in _KEY_POOLS:
+            config = _KEY_POOL_CONFIG.get('config', {})
+            strategy = get_provider_setting(config, provider, None, 'key_strategy', _KEY_POOL_CONFIG.get('strategy', 'round_robin'))
+            cooldown = get_provider_setting(config, provider, None, 'key_cooldown', _KEY_POOL_CONFIG.get('cooldown', DEFAULT_KEY_COOLDOWN))
+            _KEY_POOLS[provider] = KeyPool(provider, load_keys(provider, config), strategy, cooldown)
+    return _KEY_POOLS[provider]
+
+
+def key_pools_configured():
+    """True if any provider has more than one key."""
+    config = _KEY_POOL_CONFIG.get('config', {})
+    return any(len(load_keys(provider, config)) > 1 for provider in ENV_PREFIXES)
+
+
+def key_pool_summary():
+    return {provider: pool.summary() for provider, pool in _KEY_POOLS.items() if len(pool.keys) > 1}
@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import argparse
+from jsonl_stream import read_jsonl
+
+
+def index_shards(shard_files):
+    """
+    Maps each custom_id in `shard_files` to (file index, byte offset) of its
+    line, so results can be copied in input order without holding them in
+    memory. Returns (index, duplicate custom_ids, unreadable lines).
+    """
+    index = dict()
+    duplicates = []
+    unreadable = 0
+    for file_idx, shard_file in enumerate(shard_files):
+        offset = 0
+        with open(shard_file, 'rb') as f:
+            for line in f:
+                line_offset = offset
+                offset += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    custom_id = json.loads(line)['custom_id']
+                except (json.JSONDecodeError, KeyError):
+                    #e.g. the last line of a shard that was killed mid-write
+                    unreadable += 1
+                    continue
+                if custom_id in index:
+                    duplicates.append(custom_id)
+                    continue
+                index[custom_id] = (file_idx, line_offset)
+    return index, duplicates, unreadable
+
+
+def merge_shards(input_file_name, shard_files, output_file_name, gaps_file=None, keep_unknown=False):
+    """
+    Writes the results in `shard_files` to `output_file_name` in the order
+    of `input_file_name`. Requests with no result are gaps; they are written
+    to `gaps_file` if given, so they can be dispatched again. Results that
+    are not in the input are dropped, or with `keep_unknown` written at the
+    end. Returns (merged, gaps, duplicates, unknown, unreadable).
+    """
+    index, duplicates, unreadable = index_shards(shard_files)
+    merged = 0
+    gaps = []
+    handles = [open(shard_file, 'rb') for shard_file in shard_files]
+    tmp_file_name = output_file_name + '.tmp'
+    try:
+        with open(tmp_file_name, 'wb') as out, open(gaps_file or os.devnull, 'w') as gaps_out:
+            for data_dict in read_jsonl(input_file_name):
+                location = index.pop(data_dict['custom_id'], None)
+                if location is None:
+                    gaps.append(data_dict['custom_id'])
+                    gaps_out.write(json.dumps(data_dict) + '\n')
+                    continue
+                file_idx, offset = location
+                handles[file_idx].seek(offset)
+                line = handles[file_idx].readline()
+                out.write(line if line.endswith(b'\n') else line + b'\n')
+                merged += 1
+            #whatever is left in the index is not in the input
+            if keep_unknown:
+                for file_idx, offset in index.values():
+                    handles[file_idx].seek(offset)
+                    line = handles[file_idx].readline()
+                    out.write(line if line.endswith(b'\n') else line + b'\n')
+            out.flush()
+            os.fsync(out.fileno())
+    finally:
+        for handle in handles:
+            handle.close()
+    os.replace(tmp_file_name, output_file_name)
+    return merged, gaps, duplicates, list(index), unreadable
+
+
+def print_report(merged, gaps, duplicates, unknown, unreadable, max_ids=20):
+    print(f"Merged results: {merged}")
+    for name, custom_ids in [('Gaps (no result)', gaps), ('Duplicates (kept the first)', duplicates),
+                             ('Not in the input (dropped)', unknown)]:
+        print(f"{name}: {len(custom_ids)}")
+        if custom_ids:
+            shown = ', '.join(str(custom_id) for custom_id in custom_ids[:max_ids])
+            print(f"    {shown}{', ...' if len(custom_ids) > max_ids else ''}")
+    if unreadable:
+        print(f"Unreadable lines (skipped): {unreadable}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Merge the outputs of parallel_call.py --shard runs in input order')
+    parser.add_argument('--input_file_name', type=str, required=True, help='Input file that was sharded')
+    parser.add_argument('--shard_files', type=str, nargs='+', required=True, help='Output files of the shards, in any order')
+    parser.add_argument('--output_file_name', type=str, required=True, help='Merged output file')
+    parser.add_argument('--gaps_file', type=str, default=None, help='Write the requests that have no result here, as an input file for parallel_call.py')
+    return parser.parse_args()
+
+def main(args):
+    merged, gaps, duplicates, unknown, unreadable = merge_shards(args.input_file_name, args.shard_files,
+                                                                 args.output_file_name, args.gaps_file)
+    print_report(merged, gaps, duplicates, unknown, unreadable)
+    #a non-zero exit lets a pipeline stop on an incomplete merge
+    return 1 if gaps or duplicates or unknown else 0
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,321 @@
+import re
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+MOCK_COMPLETION = '{"explanation": "This is a mock response.", "score": 4}'
+GEMINI_PATH = re.compile(r'^/v1beta/models/(?P<model>[^:]+):generateContent')
+
+
+def sample_latency(distribution, mean_ms, sigma):
+    """
+    Draws a service latency in seconds. `constant` always returns the mean,
+    `uniform` draws from [0, 2 * mean], `exponential` has the given mean and
+    `lognormal` has the given mean with shape `sigma` (heavier tail as it grows).
+    """
+    mean = mean_ms / 1000.0
+    if distribution == 'constant':
+        return mean
+    elif distribution == 'uniform':
+        return random.uniform(0, 2 * mean)
+    elif distribution == 'exponential':
+        return random.expovariate(1.0 / mean) if mean > 0 else 0.0
+    elif distribution == 'lognormal':
+        if mean <= 0:
+            return 0.0
+        mu = math.log(mean) - sigma ** 2 / 2
+        return random.lognormvariate(mu, sigma)
+    raise ValueError(f"Unknown latency distribution: {distribution}")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def openai_response(body):
+    prompt_tokens = sum(count_tokens(m['content']) for m in body['messages'])
+    completion_tokens = count_tokens(MOCK_COMPLETION)
+    return {
+        "id": f"chatcmpl-mock-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body['model'],
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "logprobs": None,
+            "message": {"role": "assistant", "content": MOCK_COMPLETION}
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        },
+        "system_fingerprint": None
+    }
+
+def anthropic_response(body):
+    prompt_tokens = count_tokens(body.get('system', '')) + sum(
+        count_tokens(part['text']) for m in body['messages'] for part in m['content'])
+    return {
+        "id": f"msg_mock_{random.getrandbits(32):08x}",
+        "type": "message",
+        "role": "assistant",
+        "model": body['model'],
+        "content": [{"type": "text", "text": MOCK_COMPLETION}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": prompt_tokens, "output_tokens": count_tokens(MOCK_COMPLETION)}
+    }
+
+def gemini_response(body):
+    prompt_tokens = sum(count_tokens(part.get('text', '')) for c in body.get('contents', []) for part in c['parts'])
+    completion_tokens = count_tokens(MOCK_COMPLETION)
+    return {
+        "candidates": [{
+            "content": {"parts": [{"text": MOCK_COMPLETION}], "role": "model"},
+            "finishReason": 1,
+            "index": 0
+        }],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": completion_tokens,
+            "totalTokenCount": prompt_tokens + completion_tokens
+        }
+    }
+
+
+RATE_LIMIT_BODIES = {
+    'openai': {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+    'anthropic': {"type": "error", "error": {"type": "rate_limit_error", "message": "Rate limit reached (mock)"}},
+    'gemini': {"error": {"code": 429, "message": "Resource has been exhausted (mock)", "status": "RESOURCE_EXHAUSTED"}}
+}
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload):
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            self._send(200, self.server.stats())
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        raw_body = self.rfile.read(length)
+        body = json.loads(raw_body)
+        path = self.path.split('?')[0]
+        if path.endswith('/chat/completions'):
+            api, build_response = 'openai', openai_response
+        elif path.endswith('/messages'):
+            api, build_response = 'anthropic', anthropic_response
+        elif GEMINI_PATH.match(path):
+            api, build_response = 'gemini', gemini_response
+        else:
+            self._send(404, {"error": {"message": f"Unknown endpoint {path}"}})
+            return
+
+        server = self.server
+        outcome = server.draw_outcome()
+        started = time.monotonic()
+        request_key = hash(raw_body)
+        api_key = self.api_key()
+        server.first_seen.setdefault(request_key, started)
+        with server.lock:
+            server.in_flight += 1
+            server.key_in_flight[api_key] = server.key_in_flight.get(api_key, 0) + 1
+            server.key_requests[api_key] = server.key_requests.get(api_key, 0) + 1
+            over_capacity = server.capacity is not None and server.in_flight > server.capacity
+            over_capacity |= server.key_capacity is not None and server.key_in_flight[api_key] > server.key_capacity
+        try:
+            if outcome == 'rate_limited' or over_capacity:
+                server.record(api, 'rate_limited', request_key, started)
+                self._send(429, RATE_LIMIT_BODIES[api])
+                return
+            time.sleep(sample_latency(server.latency, server.latency_mean_ms, server.latency_sigma))
+            if outcome == 'malformed':
+                server.record(api, 'malformed', request_key, started)
+                self._send(200, b'{"id": "mock", "choices": [{"message": ')
+                return
+            server.record(api, 'ok', request_key, started)
+            self._send(200, build_response(body))
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+                server.key_in_flight[api_key] -= 1
+
+    def api_key(self):
+        auth = self.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            return auth[len('Bearer '):]
+        return self.headers.get('x-api-key') or self.headers.get('x-goog-api-key') or ''
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the OpenAI chat-completions, Anthropic messages and
+    Gemini generateContent APIs, for load-testing the dispatch path offline.
+
+    Every request sleeps for a latency drawn from `latency` (see
+    `sample_latency`). With probability `rate_limit_prob` it is answered with
+    a 429 instead, and with probability `malformed_prob` with a truncated JSON
+    body. If `capacity` is set, requests beyond that many in flight also get
+    a 429, and likewise beyond `key_capacity` in flight for one API key,
+    which stands in for a per-key quota. Counters are served as JSON on GET
+    /stats.
+
+    Retried requests are recognised by their identical body, so the server
+    also measures each request's latency from its first attempt to its
+    successful response, retries included.
+    """
+    daemon_threads = True
+    request_queue_size = 4096
+
+    def __init__(self, host='127.0.0.1', port=0, latency='constant', latency_mean_ms=100.0, latency_sigma=0.5,
+                 rate_limit_prob=0.0, malformed_prob=0.0, capacity=None, key_capacity=None, seed=None):
+        super().__init__((host, port), MockLLMHandler)
+        self.latency = latency
+        self.latency_mean_ms = latency_mean_ms
+        self.latency_sigma = latency_sigma
+        self.rate_limit_prob = rate_limit_prob
+        self.malformed_prob = malformed_prob
+        self.capacity = capacity
+        self.key_capacity = key_capacity
+        self.key_in_flight = dict()
+        self.key_requests = dict()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counts = dict()
+        self.first_seen = dict()
+        self.latencies = []
+        self.thread = None
+        if seed is not None:
+            random.seed(seed)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handle_error(self, request, client_address):
+        #clients hanging up mid-response (cancelled or timed-out requests) are expected under load
+        pass
+
+    def draw_outcome(self):
+        draw = random.random()
+        if draw < self.rate_limit_prob:
+            return 'rate_limited'
+        if draw < self.rate_limit_prob + self.malformed_prob:
+            return 'malformed'
+        return 'ok'
+
+    def record(self, api, outcome, request_key, started):
+        with self.lock:
+            self.counts[(api, outcome)] = self.counts.get((api, outcome), 0) + 1
+            if outcome == 'ok':
+                #identical requests in flight at once share a key, so it may already be gone
+                self.latencies.append(time.monotonic() - self.first_seen.pop(request_key, started))
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict()
+            self.first_seen = dict()
+            self.latencies = []
+            self.key_requests = dict()
+
+    def stats(self):
+        with self.lock:
+            by_outcome = dict()
+            for (api, outcome), count in self.counts.items():
+                by_outcome.setdefault(api, {})[outcome] = count
+            return {
+                'requests': sum(self.counts.values()),
+                'succeeded': len(self.latencies),
+                'rate_limited': sum(c for (_, o), c in self.counts.items() if o == 'rate_limited'),
+                'malformed': sum(c for (_, o), c in self.counts.items() if o == 'malformed'),
+                'by_api': by_outcome,
+                'by_key': dict(self.key_requests),
+                'latency_p50': percentile(self.latencies, 50),
+                'latency_p95': percentile(self.latencies, 95),
+                'latency_p99': percentile(self.latencies, 99)
+            }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def mock_env(base_url):
+    """Environment variables that point parallel_call.py at a mock server."""
+    return {
+        'OPENAI_API_KEY': 'mock',
+        'OPENAI_BASE_URL': f"{base_url}/v1",
+        'LLAMA3_API_KEY': 'mock',
+        'LLAMA3_BASE_URL': f"{base_url}/v1",
+        'CLAUDE_API_KEY': 'mock',
+        'CLAUDE_BASE_URL': base_url,
+        'GEMINI_API_KEY': 'mock',
+        'GEMINI_BASE_URL': base_url
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mock OpenAI/Anthropic/Gemini server for offline load tests')
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="Host to bind")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind")
+    parser.add_argument("--latency", type=str, default='lognormal', choices=['constant', 'uniform', 'exponential', 'lognormal'], help="Latency distribution")
+    parser.add_argument("--latency_mean_ms", type=float, default=200.0, help="Mean service latency in milliseconds")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="Shape of the lognormal latency distribution")
+    parser.add_argument("--rate_limit_prob", type=float, default=0.0, help="Probability of answering a request with a 429")
+    parser.add_argument("--malformed_prob", type=float, default=0.0, help="Probability of answering a request with malformed JSON")
+    parser.add_argument("--capacity", type=int, default=None, help="Answer with a 429 once more than this many requests are in flight")
+    parser.add_argument("--key_capacity", type=int, default=None, help="Answer with a 429 once more than this many requests are in flight for one API key")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    return parser.parse_args()
+
+def main(args):
+    server = MockLLMServer(args.host, args.port, args.latency, args.latency_mean_ms, args.latency_sigma,
+                           args.rate_limit_prob, args.malformed_prob, args.capacity, args.key_capacity, args.seed)
+    print(f"Mock LLM server listening on {server.base_url}")
+    for name, value in mock_env(server.base_url).items():
+        print(f"export {name}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -1,39 +1,72 @@
 import os
 import json
+import time
+import asyncio
 import argparse
+import contextlib
 from pyexpat import model
 import backoff
 import logging
 from tqdm import tqdm
 import google.generativeai as genai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from openai import RateLimitError as OpenAIRateLimitError
+from openai import APIConnectionError as OpenAIConnectionError, InternalServerError as OpenAIServerError
 from joblib import Parallel, delayed
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic
 from anthropic import RateLimitError as AnthropicRateLimitError
+from anthropic import APIConnectionError as AnthropicConnectionError, InternalServerError as AnthropicServerError
+from anthropic import OverloadedError as AnthropicOverloadedError, APIStatusError as AnthropicStatusError
 from google.generativeai import GenerativeModel
 from google.api_core.exceptions import ResourceExhausted as GeminiRateLimitError
+from google.api_core.exceptions import TooManyRequests as GeminiTooManyRequestsError
+from google.api_core.exceptions import ServerError as GeminiServerError
+from api_clients import get_client
+from provider_config import load_provider_config, get_provider_setting
+from rate_limiter import configure_rate_limits, get_rate_limiter, rate_limits_configured, estimate_tokens
+from result_writer import JsonlResultWriter, OrderedResultWriter, CompletionResultWriter, prepare_resume, splice_results
+from response_cache import ResponseCache
+from adaptive_concurrency import AIMDController
+from request_metrics import MetricsRecorder, record_tries, pop_last_tries, count_rate_limited, pop_rate_limited
+from dashboard import Dashboard
+from jsonl_stream import read_jsonl, count_lines
+from sharding import parse_shard, in_shard
+from fair_queue import Job, FairQueue, interleave
+from hedging import LatencyTracker, HedgeBudget, hedged
+from key_pool import KEY_STRATEGIES, configure_key_pools, get_key_pool, key_pools_configured, key_pool_summary
+from circuit_breaker import (CircuitOpenError, configure_circuit_breakers, get_circuit_breaker, circuit_breakers_configured,
+                             circuit_breaker_summary)
+from run_limits import (configure_run_limits, run_limits_configured, attempt_timeout, deadline_passed, time_left,
+                        get_retry_budget, give_up_reason, start_sync_request, failed_sync_attempts, backoff_limits, pop_giveup_reason, dead_letter_entry)
 
 
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')
 LLAMA3_API_KEY = os.getenv('LLAMA3_API_KEY')
 LLAMA3_BASE_URL = os.getenv('LLAMA3_BASE_URL')
 CLAUDE_API_KEY = os.getenv('CLAUDE_API_KEY')
+CLAUDE_BASE_URL = os.getenv('CLAUDE_BASE_URL')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+GEMINI_BASE_URL = os.getenv('GEMINI_BASE_URL')
+
+OPENAI_MODELS = ['gpt-4', 'gpt-4-turbo', 'gpt-3.5-turbo-0125', 'gpt-4o']
+LLAMA3_MODELS = ['llama3-70b']
+CLAUDE_MODELS = ['claude3-opus']
+GEMINI_MODELS = ['gemini-1.5-flash', 'gemini-1.5-pro']
+
+PROVIDER_MODELS = {
+    'openai': OPENAI_MODELS,
+    'llama3': LLAMA3_MODELS,
+    'claude': CLAUDE_MODELS,
+    'gemini': GEMINI_MODELS
+}
 
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-def read_jsonl(file_name):
-    results_data = []
-    with open(file_name) as f:
-        for line in f:
-            results_data.append(json.loads(line))
-    return results_data
-
 def write_jsonl(file_name, responses):
     with open(file_name, 'w') as f:
         for response in responses:
@@ -146,7 +179,11 @@ def format_gemini_result_dict(res, custom_id, model):
                             'name': None
                         }
                     }],
-                    "usage": None,
+                    "usage": {
+                        'prompt_tokens': res.usage_metadata.prompt_token_count,
+                        'completion_tokens': res.usage_metadata.candidates_token_count,
+                        'total_tokens': res.usage_metadata.total_token_count
+                    },
                     "system_fingerprint": None
                 }
             },
@@ -155,8 +192,8 @@ def format_gemini_result_dict(res, custom_id, model):
     return result_dict
 
 
-def call_openai(data_dict):
-    openai_client = OpenAI(api_key = OPENAI_API_KEY)
+def call_openai(data_dict, api_key = None):
+    openai_client = get_client('openai', base_url = OPENAI_BASE_URL, api_key = api_key or OPENAI_API_KEY, max_retries = 0)
     
     model = data_dict['body']['model']
     max_tokens = data_dict['body']['max_tokens']
@@ -169,23 +206,21 @@ def call_openai(data_dict):
             model = model, 
             messages = messages,
             max_tokens = max_tokens, 
-            temperature = temperature
+            temperature = temperature,
+            timeout = attempt_timeout('openai', data_dict['body']['model'])
         )
         return_res = format_openai_result_dict(res.model_dump(), custom_id)
         return return_res
-    except OpenAIRateLimitError as e:
+    except (OpenAIRateLimitError, OpenAIConnectionError, OpenAIServerError) as e:
         raise
     except Exception as e:
         print(e)
         logger.error(f"Error processing request for custom_id={custom_id}: {str(e)}")
-        return {'error': str(e), 'custom_id': custom_id}
+        return {'error': str(e), 'error_type': type(e).__name__, 'custom_id': custom_id}
         
         
-def call_llama3(data_dict):
-    openai_client = OpenAI(
-        base_url = LLAMA3_BASE_URL,
-        api_key = LLAMA3_API_KEY
-    )
+def call_llama3(data_dict, api_key = None):
+    openai_client = get_client('openai', base_url = LLAMA3_BASE_URL, api_key = api_key or LLAMA3_API_KEY, max_retries = 0)
     
     model = data_dict['body']['model']
     if model == 'llama3-70b':
@@ -200,22 +235,21 @@ def call_llama3(data_dict):
             model = model, 
             messages = messages,
             max_tokens = max_tokens, 
-            temperature = temperature
+            temperature = temperature,
+            timeout = attempt_timeout('llama3', data_dict['body']['model'])
         )
         return_res = format_openai_result_dict(res.model_dump(), custom_id)
         return return_res
-    except OpenAIRateLimitError as e:
+    except (OpenAIRateLimitError, OpenAIConnectionError, OpenAIServerError) as e:
         raise
     except Exception as e:
         print(e)
         logger.error(f"Error processing request for custom_id={custom_id}: {str(e)}")
-        return {'error': str(e), 'custom_id': custom_id}
+        return {'error': str(e), 'error_type': type(e).__name__, 'custom_id': custom_id}
     
 
-def call_claude(data_dict):
-    anthropic_client = Anthropic(
-        api_key = CLAUDE_API_KEY
-    )
+def call_claude(data_dict, api_key = None):
+    anthropic_client = get_client('anthropic', base_url = CLAUDE_BASE_URL, api_key = api_key or CLAUDE_API_KEY, max_retries = 0)
     
     model = data_dict['body']['model']
     if model == 'claude3-opus':
@@ -231,40 +265,26 @@ def call_claude(data_dict):
             max_tokens = max_tokens,
             temperature = temperature,
             system = system_prompt,
-            messages = messages
+            messages = messages,
+            timeout = attempt_timeout('claude', data_dict['body']['model'])
         )
         return_res = format_anthropic_result_dict(res.to_dict(), custom_id)
         return return_res
-    except AnthropicRateLimitError as e:
+    except (AnthropicRateLimitError, AnthropicConnectionError, AnthropicServerError, AnthropicOverloadedError) as e:
         raise
+    except AnthropicStatusError as e:
+        #any other 5xx is retried as well; 4xx requests will not succeed on a retry
+        if e.status_code >= 500:
+            raise
+        print(e)
+        logger.error(f"Error processing request for custom_id={custom_id}: {str(e)}")
+        return {'error': str(e), 'error_type': type(e).__name__, 'custom_id': custom_id}
     except Exception as e:
         print(e)
         logger.error(f"Error processing request for custom_id={custom_id}: {str(e)}")
-        return {'error': str(e), 'custom_id': custom_id}
-    
-def call_gemini(data_dict):
-
-    genai.configure(api_key = GEMINI_API_KEY)
-    
-    safety_settings = [
-        {
-            "category": "HARM_CATEGORY_HARASSMENT",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_HATE_SPEECH",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-            "threshold": "BLOCK_NONE",
-        },
-    ]
+        return {'error': str(e), 'error_type': type(e).__name__, 'custom_id': custom_id}
     
+def call_gemini(data_dict, api_key = None):
     model = data_dict['body']['model']
     if model == 'gemini-1.5-flash':
         model = 'gemini-1.5-flash-latest'
@@ -280,73 +300,753 @@ def call_gemini(data_dict):
         "response_mime_type": "text/plain",
     }
     system_prompt, messages = format_gemini_messages(data_dict['body']['messages'])
-    client = GenerativeModel(
-        model_name = model,
-        safety_settings = safety_settings,
-        generation_config = generation_config,
-        system_instruction = system_prompt
-    )
+    client = get_client('gemini', base_url = GEMINI_BASE_URL, api_key = api_key or GEMINI_API_KEY, generation_config = {
+        'model': model,
+        'generation_config': generation_config,
+        'system_instruction': system_prompt
+    })
     try:
-        res = client.generate_content(messages)
+        res = client.generate_content(messages, request_options = {'timeout': attempt_timeout('gemini', data_dict['body']['model'])})
         return_res = format_gemini_result_dict(res, custom_id, model)
         return return_res
-    except GeminiRateLimitError as e:
+    except (GeminiRateLimitError, GeminiTooManyRequestsError, GeminiServerError) as e:
         raise
     except Exception as e:
         print(type(e))
         print(e)
         logger.error(f"Error processing request for custom_id={custom_id}: {str(e)}")
-        return {'error': str(e), 'custom_id': custom_id}
+        return {'error': str(e), 'error_type': type(e).__name__, 'custom_id': custom_id}
+    
+
+
+
+# The async variants raise every error; retries and error results are
+# handled by send_request so the dispatcher sees each failed attempt.
+async def acall_openai(data_dict, api_key = None):
+    openai_client = get_client('openai', base_url = OPENAI_BASE_URL, api_key = api_key or OPENAI_API_KEY, is_async = True, max_retries = 0)
+    
+    model = data_dict['body']['model']
+    max_tokens = data_dict['body']['max_tokens']
+    temperature = data_dict['body']['temperature']
+    custom_id = data_dict['custom_id']
+    messages = data_dict['body']['messages']
+    
+    res = await openai_client.chat.completions.create(
+        model = model, 
+        messages = messages,
+        max_tokens = max_tokens, 
+        temperature = temperature
+    )
+    return format_openai_result_dict(res.model_dump(), custom_id)
+
+
+async def acall_llama3(data_dict, api_key = None):
+    openai_client = get_client('openai', base_url = LLAMA3_BASE_URL, api_key = api_key or LLAMA3_API_KEY, is_async = True, max_retries = 0)
+    
+    model = data_dict['body']['model']
+    if model == 'llama3-70b':
+        model = "meta-llama/Meta-Llama-3-70B-Instruct"
+    max_tokens = data_dict['body']['max_tokens']
+    temperature = data_dict['body']['temperature']
+    custom_id = data_dict['custom_id']
+    messages = data_dict['body']['messages']
+    
+    res = await openai_client.chat.completions.create(
+        model = model, 
+        messages = messages,
+        max_tokens = max_tokens, 
+        temperature = temperature
+    )
+    return format_openai_result_dict(res.model_dump(), custom_id)
+
+
+async def acall_claude(data_dict, api_key = None):
+    anthropic_client = get_client('anthropic', base_url = CLAUDE_BASE_URL, api_key = api_key or CLAUDE_API_KEY, is_async = True, max_retries = 0)
     
+    model = data_dict['body']['model']
+    if model == 'claude3-opus':
+        model = 'claude-3-opus-20240229'
+    max_tokens = data_dict['body']['max_tokens']
+    temperature = data_dict['body']['temperature']
+    custom_id = data_dict['custom_id']
+    system_prompt, messages = format_anthropic_messages(data_dict['body']['messages'])
+    
+    res = await anthropic_client.messages.create(
+        model = model,
+        max_tokens = max_tokens,
+        temperature = temperature,
+        system = system_prompt,
+        messages = messages
+    )
+    return format_anthropic_result_dict(res.to_dict(), custom_id)
 
 
+async def acall_gemini(data_dict, api_key = None):
+    model = data_dict['body']['model']
+    if model == 'gemini-1.5-flash':
+        model = 'gemini-1.5-flash-latest'
+    elif model == 'gemini-1.5-pro':
+        model = 'gemini-1.5-pro-latest'
+    max_tokens = data_dict['body']['max_tokens']
+    temperature = data_dict['body']['temperature']
+    custom_id = data_dict['custom_id']
+    
+    generation_config = {
+        "temperature": temperature,
+        "max_output_tokens": max_tokens,
+        "response_mime_type": "text/plain",
+    }
+    system_prompt, messages = format_gemini_messages(data_dict['body']['messages'])
+    client = get_client('gemini', base_url = GEMINI_BASE_URL, api_key = api_key or GEMINI_API_KEY, generation_config = {
+        'model': model,
+        'generation_config': generation_config,
+        'system_instruction': system_prompt
+    }, is_async = True)
+    if GEMINI_BASE_URL:
+        #a custom endpoint uses genai's REST transport, which has no async client
+        res = await asyncio.to_thread(client.generate_content, messages)
+    else:
+        res = await client.generate_content_async(messages)
+    return format_gemini_result_dict(res, custom_id, model)
 
-@backoff.on_exception(backoff.expo, OpenAIRateLimitError)
+
+def get_provider(model):
+    for provider, models in PROVIDER_MODELS.items():
+        if model in models:
+            return provider
+    return None
+
+
+def throttle(data_dict, key = None):
+    rate_limiter = get_rate_limiter(get_provider(data_dict['body']['model']), data_dict['body']['model'], key)
+    if rate_limiter is not None:
+        rate_limiter.acquire(estimate_tokens(data_dict['body']))
+
+async def athrottle(data_dict, key = None):
+    rate_limiter = get_rate_limiter(get_provider(data_dict['body']['model']), data_dict['body']['model'], key)
+    if rate_limiter is not None:
+        await rate_limiter.acquire_async(estimate_tokens(data_dict['body']))
+
+
+#timeouts (SDK timeouts are connection errors) also count, so a hanging provider opens its breaker
+#Anthropic's 529 (OverloadedError) is not an InternalServerError
+PROVIDER_DOWN_ERRORS = (OpenAIConnectionError, OpenAIServerError, AnthropicConnectionError, AnthropicServerError, AnthropicOverloadedError,
+                        GeminiServerError, asyncio.TimeoutError)
+
+def guarded_call(call_fn, data_dict):
+    """
+    Makes one sync attempt: picks an API key from the provider's pool,
+    meters the attempt with that key's rate limiter and reports connection
+    errors and 5xx responses to the model's circuit breaker and 429s to the
+    key pool. While the breaker is open it raises CircuitOpenError instead
+    of waiting, so the joblib workers, which all providers share, are not
+    parked on a provider that is down.
+    """
+    model = data_dict['body']['model']
+    provider = get_provider(model)
+    breaker = get_circuit_breaker(provider, model)
+    wait = breaker.reserve()
+    if wait > 0:
+        raise CircuitOpenError(f"Circuit for {breaker.name} is open, next probe in {wait:.0f}s")
+    key_pool = get_key_pool(provider)
+    key = key_pool.acquire()
+    try:
+        throttle(data_dict, key)
+        result = call_fn(data_dict, key.value)
+    except Exception as e:
+        key_pool.release(key, is_rate_limit_error(e), retry_after(e))
+        if is_rate_limit_error(e):
+            count_rate_limited()
+        if is_provider_down_error(e):
+            breaker.on_failure()
+        raise
+    key_pool.release(key)
+    breaker.on_success()
+    return result
+
+
+#every attempt, including retries, goes through the circuit breaker and the rate limiter;
+#a call that runs out of tries, retry budget or time returns None
+@backoff.on_exception(backoff.expo, (OpenAIRateLimitError,) + PROVIDER_DOWN_ERRORS, on_success = record_tries, **backoff_limits('openai'))
 def backoff_openai_call(data_dict):
-    return call_openai(data_dict)
+    return guarded_call(call_openai, data_dict)
     
-@backoff.on_exception(backoff.expo, OpenAIRateLimitError)
+@backoff.on_exception(backoff.expo, (OpenAIRateLimitError,) + PROVIDER_DOWN_ERRORS, on_success = record_tries, **backoff_limits('llama3'))
 def backoff_llama3_call(data_dict):
-    return call_llama3(data_dict)
+    return guarded_call(call_llama3, data_dict)
 
-@backoff.on_exception(backoff.expo, Exception)
+#call_claude only raises the status errors that are worth retrying (5xx)
+@backoff.on_exception(backoff.expo, (AnthropicRateLimitError, AnthropicStatusError) + PROVIDER_DOWN_ERRORS, on_success = record_tries,
+                      **backoff_limits('claude'))
 def backoff_claude_call(data_dict):
-    return call_claude(data_dict)
+    return guarded_call(call_claude, data_dict)
 
-@backoff.on_exception(backoff.expo, GeminiRateLimitError)
+#the gRPC transport raises ResourceExhausted on a 429, the REST transport TooManyRequests
+@backoff.on_exception(backoff.expo, (GeminiRateLimitError, GeminiTooManyRequestsError) + PROVIDER_DOWN_ERRORS, on_success = record_tries,
+                      **backoff_limits('gemini'))
 def backoff_gemini_call(data_dict):
-    return call_gemini(data_dict)
-        
-    
-    
+    return guarded_call(call_gemini, data_dict)
+
+
+CALL_FNS = {
+    'openai': (backoff_openai_call, acall_openai),
+    'llama3': (backoff_llama3_call, acall_llama3),
+    'claude': (backoff_claude_call, acall_claude),
+    'gemini': (backoff_gemini_call, acall_gemini)
+}
+
+def get_call_fns(model):
+    """
+    Returns the (sync backoff-wrapped, async raw) call functions for a model,
+    or (None, None) if the model is not supported.
+    """
+    return CALL_FNS.get(get_provider(model), (None, None))
+
+
+RATE_LIMIT_ERRORS = (OpenAIRateLimitError, AnthropicRateLimitError, GeminiRateLimitError, GeminiTooManyRequestsError)
+
+def error_status(e):
+    """HTTP status of an SDK error, if it carries one."""
+    status = getattr(e, 'status_code', None)
+    if status is None and isinstance(getattr(e, 'code', None), int):
+        status = e.code
+    return status
+
+def is_rate_limit_error(e):
+    return isinstance(e, RATE_LIMIT_ERRORS) or error_status(e) == 429
+
+def retry_after(e):
+    """Seconds from the Retry-After header of an SDK error, if it has one."""
+    response = getattr(e, 'response', None)
+    try:
+        return float(response.headers['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+def is_overload_error(e):
+    """Rate-limit (429) and server-side (5xx, incl. Anthropic's 529) errors are retried."""
+    status = error_status(e)
+    return isinstance(e, RATE_LIMIT_ERRORS) or status == 429 or (status is not None and status >= 500)
+
+def is_provider_down_error(e):
+    """Connection errors and 5xx responses count towards opening the circuit breaker; 429s do not."""
+    status = error_status(e)
+    return isinstance(e, PROVIDER_DOWN_ERRORS) or (status is not None and status >= 500)
+
+
+async def send_request(data_dict, call_fn, controller = None, trace = None):
+    """
+    Sends one request, retrying rate-limit, server and connection errors and
+    timeouts with jittered exponential backoff (capped at 60s). Each attempt
+    waits while the model's circuit breaker is open, takes an API key from
+    the provider's pool, is metered by that key's rate limiter, is cut off after the request timeout and, in adaptive mode,
+    holds a slot of the provider's AIMD controller, which is told about its
+    latency or overload. Other errors are returned as error results.
+
+    A request that runs out of tries, retry budget or run time is returned
+    as an error result too, and the reason is stored as
+    `trace['dead_letter']`. The number of attempts, and of those answered
+    with a 429, are stored in `trace`, if given. The caller counts the
+    request towards its provider's retry budget, once for all its hedges.
+    """
+    custom_id = data_dict['custom_id']
+    model = data_dict['body']['model']
+    provider = get_provider(model)
+    breaker = get_circuit_breaker(provider, model)
+    key_pool = get_key_pool(provider)
+    trace = trace if trace is not None else dict()
+    trace['attempts'] = 0
+    trace['rate_limited'] = 0
+    wait_gen = backoff.expo(max_value = 60)
+    next(wait_gen)
+    while True:
+        if not await breaker.acquire_async(time_left()) or deadline_passed():
+            trace['dead_letter'] = 'deadline'
+            return {'error': 'Run deadline passed before the request could be sent', 'error_type': 'DeadlineExceeded', 'custom_id': custom_id}
+        key = key_pool.acquire()
+        trace['attempts'] += 1
+        try:
+            await athrottle(data_dict, key)
+            if controller is not None:
+                async with controller:
+                    start = time.monotonic()
+                    try:
+                        result = await asyncio.wait_for(call_fn(data_dict, key.value), attempt_timeout(provider, model))
+                    except Exception as e:
+                        if is_overload_error(e):
+                            controller.on_overload()
+                        raise
+                    controller.on_success(time.monotonic() - start)
+            else:
+                result = await asyncio.wait_for(call_fn(data_dict, key.value), attempt_timeout(provider, model))
+            key_pool.release(key)
+            breaker.on_success()
+            return result
+        except BaseException as e:
+            #a cancelled (e.g. hedged) attempt still gives its key back
+            key_pool.release(key, is_rate_limit_error(e), retry_after(e))
+            if not isinstance(e, Exception):
+                raise
+            error = str(e) or type(e).__name__
+            if is_rate_limit_error(e):
+                trace['rate_limited'] += 1
+            if is_provider_down_error(e):
+                breaker.on_failure()
+            elif not is_overload_error(e):
+                logger.error(f"Error processing request for custom_id={custom_id}: {error}")
+                return {'error': error, 'error_type': type(e).__name__, 'custom_id': custom_id}
+            reason = give_up_reason(provider, model, trace['attempts'])
+            if reason is not None:
+                logger.error(f"Giving up on custom_id={custom_id} ({reason}) after {trace['attempts']} attempts: {error}")
+                trace['dead_letter'] = reason
+                return {'error': error, 'error_type': type(e).__name__, 'custom_id': custom_id}
+        wait = backoff.full_jitter(next(wait_gen))
+        remaining = time_left()
+        await asyncio.sleep(wait if remaining is None else min(wait, remaining))
+
+
+def from_cache(result):
+    return result, 0.0, 0.0, 0, 0, None
+
+def unsupported_model_result(data_dict):
+    return {'error': f"Unsupported model: {data_dict['body']['model']}", 'error_type': 'UnsupportedModel', 'custom_id': data_dict['custom_id']}
+
+def route_result(data_dict, result, dead_letter, reason = None, attempts = 0):
+    """
+    Returns the result to write to the main output, or None if the request
+    failed and was written to `dead_letter` instead.
+    """
+    if dead_letter is None or result.get('error') is None:
+        return result
+    dead_letter.write(dead_letter_entry(data_dict, result, reason, attempts))
+    return None
+
+def timed_call(call_fn, data_dict, enqueued_at):
+    """
+    Runs a call in a joblib worker and returns (result, queue wait, wall
+    time, attempts, attempts answered with a 429, dead-letter reason). The
+    reason is None unless the call ran out of tries, retry budget or run
+    time, or found its circuit open ("circuit_open").
+    """
+    started_at = time.time()
+    if deadline_passed():
+        result = {'error': 'Run deadline passed before the request could be sent', 'error_type': 'DeadlineExceeded',
+                  'custom_id': data_dict['custom_id']}
+        return result, started_at - enqueued_at, 0.0, 0, 0, 'deadline'
+    start_sync_request(get_provider(data_dict['body']['model']), data_dict['body']['model'])
+    reason = None
+    try:
+        result = call_fn(data_dict)
+    except CircuitOpenError as e:
+        result = {'error': str(e), 'error_type': type(e).__name__, 'custom_id': data_dict['custom_id']}
+        reason = 'circuit_open'
+    tries = pop_last_tries()
+    if reason == 'circuit_open':
+        #backoff did not see the call end, so only the attempts that were sent and failed are known
+        tries = failed_sync_attempts()
+    giveup = pop_giveup_reason()
+    if giveup is not None:
+        reason, error, error_type = giveup
+        result = {'error': error, 'error_type': error_type, 'custom_id': data_dict['custom_id']}
+    return result, started_at - enqueued_at, time.time() - started_at, tries, pop_rate_limited(), reason
+
+
+def tagged(task_id, fn, *fn_args):
+    """Runs a joblib task and returns (task_id, result), so results can be matched to requests in any order."""
+    return task_id, fn(*fn_args)
+
+
+def dispatch_joblib(jobs, n_jobs, cache = None, metrics = None, total = None, output_order = 'input', dashboard = None):
+    """
+    Dispatches the requests of `jobs` (see fair_queue.py) with joblib,
+    routing each one to its model's backend. Cache lookups and stores happen
+    in this process; cached results pass through the pool so they keep
+    their place in the input order.
+
+    Requests are handed to the pool as workers free up, taking the next one
+    from the job the fair scheduler picks, so a small high-priority job is
+    not stuck behind a large one. A job's data may be a generator: joblib
+    only pulls a few batches ahead of its workers, and each request is
+    dropped once its result is written. Results go to each job's writer,
+    in its input order or with `output_order` "completion" as they finish,
+    and failed requests to its dead letter instead.
+
+    Requests count as in flight on `dashboard` from when they are handed to
+    joblib, which queues a few batches ahead of its workers.
+
+    All providers share the one pool of `n_jobs` workers, so unlike in
+    `dispatch_async` a slow provider can hold up the others.
+    """
+    dashboard = dashboard or Dashboard(total)
+    progress = tqdm(total = total, disable = dashboard.display)
+    cached_idxs = set()
+    #requests handed to joblib whose results have not been written yet
+    in_flight = dict()
+    providers = set()
+
+    def tasks():
+        requests = interleave(jobs, lambda data_dict: estimate_tokens(data_dict['body']))
+        for idx, (job, data_dict) in enumerate(requests):
+            in_flight[idx] = (job, data_dict)
+            provider = get_provider(data_dict['body']['model'])
+            if provider not in providers:
+                providers.add(provider)
+                if len(providers) == 2:
+                    logger.warning("Requests for several providers share the joblib workers, so a slow provider holds up "
+                                   "the others; use --async_mode to give each provider its own workers")
+            dashboard.on_queued(provider)
+            dashboard.on_started(provider)
+            result = cache.get(data_dict) if cache is not None else None
+            if result is not None:
+                cached_idxs.add(idx)
+                yield delayed(tagged)(idx, from_cache, result)
+            else:
+                call_fn, _ = get_call_fns(data_dict['body']['model'])
+                yield delayed(tagged)(idx, timed_call, call_fn or unsupported_model_result, data_dict, time.time())
 
-def parse_args():
+    #rate limiters, key pools, configured circuit breakers and run limits must be shared by all workers, so use threads
+    #for them; otherwise each worker process keeps its own breakers and limits with the default settings
+    prefer = 'threads' if (rate_limits_configured() or key_pools_configured() or circuit_breakers_configured()
+                           or run_limits_configured()) else None
+    #an ordered generator holds back every result behind the slowest earlier one
+    return_as = 'generator_unordered' if output_order == 'completion' else 'generator'
+    results = Parallel(n_jobs = n_jobs, prefer = prefer, return_as = return_as)(tasks())
+    for idx, (result, queue_wait, wall_time, attempts, rate_limited, reason) in results:
+        job, data_dict = in_flight.pop(idx)
+        provider = get_provider(data_dict['body']['model'])
+        cached = idx in cached_idxs
+        if cache is not None and not cached:
+            cache.put(data_dict, result)
+        cached_idxs.discard(idx)
+        if metrics is not None:
+            metrics.record(data_dict, provider, result, wall_time, queue_wait, attempts, cached, rate_limited = rate_limited)
+        dashboard.on_finished(provider, result, attempts, rate_limited)
+        result = route_result(data_dict, result, job.dead_letter, reason, attempts)
+        if result is not None:
+            job.writer.write(result)
+        job.on_result()
+        progress.update(1)
+    progress.close()
+
+
+async def dispatch_async(jobs, max_concurrency, cache = None, provider_config = None,
+                         adaptive = False, initial_concurrency = 8, metrics = None, lookahead = 10000, total = None,
+                         hedge = False, hedge_percentile = 95, hedge_budget = 0.05, output_order = 'input',
+                         dashboard = None):
+    """
+    Dispatches the requests of `jobs` (see fair_queue.py) from a single
+    event loop.
+
+    Each request is routed to its provider's queue. Every provider has its
+    own pool of workers, sized by its "max_concurrency" setting (default
+    `max_concurrency`), its own rate limiters and, when `adaptive`, its own
+    AIMD controller, so a slow provider does not hold up the others.
+    A provider's queue hands its workers the requests of the highest
+    priority job first and shares them between jobs of equal priority by
+    weight. Results are handed to each job's writer as soon as they can be
+    written in its input order, or with `output_order` "completion" as soon
+    as they finish, and failed requests to its dead letter instead. Returns
+    the AIMD controllers by provider.
+
+    With `hedge`, a request still running after its provider's observed
+    `hedge_percentile` latency is sent a second time; the first response
+    wins and the other is cancelled. Hedges are capped at `hedge_budget`
+    times the provider's requests.
+
+    A job's data may be a generator. It is read at most `lookahead`
+    requests past the job's oldest request whose result has not been
+    written, which bounds both the queued requests and the results held
+    back for ordering.
+
+    Each request is reported to `dashboard` when it is queued, when a
+    worker takes it and when it finishes.
+    """
+    provider_config = provider_config or {}
+    dashboard = dashboard or Dashboard(total)
+    writer_cls = CompletionResultWriter if output_order == 'completion' else OrderedResultWriter
+    result_writers = {job: writer_cls(job.writer) for job in jobs}
+    advanced = {job: asyncio.Event() for job in jobs}
+    progress = tqdm(total = total, disable = dashboard.display)
+    queues = dict()
+    n_workers = dict()
+    controllers = dict()
+    hedge_trackers = dict()
+    hedge_budgets = dict()
+    workers = []
+
+    def write(job, idx, data_dict, provider, result, reason = None, attempts = 0, rate_limited = 0, started = True):
+        dashboard.on_finished(provider, result, attempts, rate_limited, started)
+        result_writers[job].write(idx, route_result(data_dict, result, job.dead_letter, reason, attempts))
+        job.on_result()
+        advanced[job].set()
+        progress.update(1)
+
+    async def worker(provider, queue, controller):
+        _, call_fn = CALL_FNS[provider]
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            job, idx, data_dict, enqueued_at = item
+            dashboard.on_started(provider)
+            started_at = time.monotonic()
+            #once per request, however many hedged copies of it are sent
+            get_retry_budget(provider).on_request()
+            traces = []
+
+            def attempt():
+                traces.append(dict())
+                return send_request(data_dict, call_fn, controller, traces[-1])
+
+            was_hedged = False
+            if hedge:
+                result, was_hedged = await hedged(attempt, hedge_trackers[provider], hedge_budgets[provider], provider)
+            else:
+                result = await attempt()
+            attempts = sum(trace.get('attempts', 0) for trace in traces)
+            rate_limited = sum(trace.get('rate_limited', 0) for trace in traces)
+            reason = next((trace['dead_letter'] for trace in traces if 'dead_letter' in trace), None)
+            if cache is not None:
+                #file writes and evictions would otherwise stall every request in flight
+                await asyncio.to_thread(cache.put, data_dict, result)
+            if metrics is not None:
+                metrics.record(data_dict, provider, result, time.monotonic() - started_at,
+                               started_at - enqueued_at, attempts, hedged = was_hedged, rate_limited = rate_limited)
+            write(job, idx, data_dict, provider, result, reason, attempts, rate_limited)
+
+    def start_provider(provider):
+        concurrency = get_provider_setting(provider_config, provider, None, 'max_concurrency', max_concurrency)
+        queues[provider] = FairQueue()
+        n_workers[provider] = concurrency
+        if adaptive:
+            controllers[provider] = AIMDController(provider, initial = initial_concurrency, max_limit = concurrency)
+        if hedge:
+            hedge_trackers[provider] = LatencyTracker(q = hedge_percentile)
+            hedge_budgets[provider] = HedgeBudget(hedge_budget)
+        for _ in range(concurrency):
+            workers.append(asyncio.create_task(worker(provider, queues[provider], controllers.get(provider))))
+
+    async def produce(job):
+        result_writer = result_writers[job]
+        for idx, data_dict in enumerate(job.data):
+            while idx - result_writer.next_idx >= lookahead:
+                advanced[job].clear()
+                await advanced[job].wait()
+            provider = get_provider(data_dict['body']['model'])
+            result = cache.get(data_dict) if cache is not None and provider is not None else None
+            if provider is None:
+                result = unsupported_model_result(data_dict)
+            if result is not None:
+                if metrics is not None:
+                    metrics.record(data_dict, provider, result, attempts = 0, cached = provider is not None)
+                write(job, idx, data_dict, provider, result, attempts = 0, started = False)
+                continue
+            if provider not in queues:
+                start_provider(provider)
+            queues[provider].put_nowait(job, (job, idx, data_dict, time.monotonic()), estimate_tokens(data_dict['body']))
+            dashboard.on_queued(provider)
+            #let workers and the other jobs start on their first requests while the rest are routed
+            if idx % 1000 == 0:
+                await asyncio.sleep(0)
+
+    await asyncio.gather(*(produce(job) for job in jobs))
+    #one stop marker per worker
+    for provider, queue in queues.items():
+        queue.close(n_workers[provider])
+    await asyncio.gather(*workers)
+    progress.close()
+    for provider, budget in hedge_budgets.items():
+        logger.info(f"Hedging [{provider}]: {budget.hedges} hedges for {budget.started} requests")
+    return controllers
+
+
+def parse_args(argv = None):
     parser = argparse.ArgumentParser(description = 'parallel processing')
-    parser.add_argument("--input_file_name", type=str, help = "Input file name")
-    parser.add_argument("--output_file_name", type=str, help = "Output file name")
-    parser.add_argument("--n_jobs", type=int, help = "Number of parallel jobs to run")
-    args = parser.parse_args()
+    parser.add_argument("--input_file_name", type=str, nargs='+', help = "Input file name; several files are dispatched together as separate jobs sharing the providers (see --priorities and --weights)")
+    parser.add_argument("--output_file_name", type=str, nargs='+', help = "Output file name, one per input file")
+    parser.add_argument("--priorities", type=int, nargs='+', default=None, help = "Priority of each input file (default 0); waiting requests of higher-priority files are always sent first")
+    parser.add_argument("--weights", type=float, nargs='+', default=None, help = "Weight of each input file (default 1); files of equal priority share the providers in proportion to their weights")
+    parser.add_argument("--n_jobs", type=int, help = "Number of joblib workers, shared by all providers: a slow provider can take them all, use --async_mode to isolate providers")
+    parser.add_argument("--async_mode", action="store_true", help = "Dispatch requests with asyncio from a single process instead of joblib workers")
+    parser.add_argument("--max_concurrency", type=int, default=256, help = "Maximum number of in-flight requests per provider in async mode (overridable with max_concurrency in --provider_config)")
+    parser.add_argument("--adaptive", action="store_true", help = "In async mode, adapt concurrency (AIMD) to the provider's latency and rate-limit/5xx responses, up to --max_concurrency")
+    parser.add_argument("--initial_concurrency", type=int, default=8, help = "Starting concurrency for --adaptive")
+    parser.add_argument("--provider_config", type=str, default=None, help = "JSON file with per-provider/per-model settings such as rpm and tpm")
+    parser.add_argument("--rpm", type=int, default=None, help = "Default requests/min budget per (provider, model)")
+    parser.add_argument("--tpm", type=int, default=None, help = "Default tokens/min budget per (provider, model)")
+    parser.add_argument("--key_strategy", type=str, choices=KEY_STRATEGIES, default='round_robin', help = "How requests are spread over a provider's API keys (<PROVIDER>_API_KEYS or api_keys in --provider_config)")
+    parser.add_argument("--key_cooldown", type=float, default=10.0, help = "Seconds a rate-limited API key is rotated out of its pool when the provider sends no Retry-After")
+    parser.add_argument("--breaker_failures", type=int, default=5, help = "Consecutive connection/5xx failures after which a (provider, model) circuit opens; its requests are parked in async mode and sent to the dead-letter file with joblib; 0 disables")
+    parser.add_argument("--breaker_timeout", type=float, default=30.0, help = "Seconds an open circuit waits before a half-open probe request (doubles after each failed probe)")
+    parser.add_argument("--request_timeout", type=float, default=600.0, help = "Seconds before one attempt of a request is abandoned (overridable with request_timeout in --provider_config)")
+    parser.add_argument("--max_tries", type=int, default=10, help = "Attempts per request before it is given up (overridable with max_tries in --provider_config)")
+    parser.add_argument("--retry_budget", type=float, default=None, help = "Maximum retries as a fraction of each provider's requests, e.g. 0.1 (overridable with retry_budget in --provider_config)")
+    parser.add_argument("--deadline", type=float, default=None, help = "Seconds after which no more attempts are started; unsent requests are given up")
+    parser.add_argument("--dead_letter_file", type=str, default=None, help = "JSONL for failed requests, kept out of the output file (default: <output_file_name>.dead_letter.jsonl)")
+    parser.add_argument("--retry_failed", "--retry-failed", action="store_true", help = "Re-send only the requests in the dead-letter file and splice their results into the output file")
+    parser.add_argument("--shard", type=str, default=None, help = "Dispatch only shard i/N (0 <= i < N) of the input, partitioned by a stable hash of custom_id; combine the shard outputs with merge_shards.py")
+    parser.add_argument("--resume", action="store_true", help = "Keep finished results in the output file and only dispatch the remaining requests")
+    parser.add_argument("--fsync_every", type=int, default=100, help = "Flush and fsync the output file after this many results")
+    parser.add_argument("--cache_dir", type=str, default=".llm_cache", help = "Directory of the on-disk response cache for temperature-0 requests")
+    parser.add_argument("--cache_max_mb", type=int, default=1024, help = "Size limit of the response cache; least recently used entries are evicted beyond it")
+    parser.add_argument("--no_cache", "--no-cache", action="store_true", help = "Neither read from nor write to the response cache")
+    parser.add_argument("--output_order", "--output-order", type=str, choices=['input', 'completion'], default='input', help = "Write results in input order, or as they complete so none are held back behind a slow request (restore input order with reorder_outputs.py)")
+    parser.add_argument("--lookahead", type=int, default=10000, help = "In async mode, read at most this many requests ahead of the oldest unwritten result (keep it above the total concurrency)")
+    parser.add_argument("--hedge", action="store_true", help = "In async mode, re-send requests that exceed their provider's observed latency percentile and keep the first response")
+    parser.add_argument("--hedge_percentile", type=float, default=95, help = "Latency percentile after which a request is hedged")
+    parser.add_argument("--hedge_budget", type=float, default=0.05, help = "Maximum hedges as a fraction of each provider's requests")
+    parser.add_argument("--dashboard", action="store_true", help = "Show a live view of finished/in-flight/queued requests, throughput, ETA, 429 rate and errors per provider instead of the progress bar")
+    parser.add_argument("--prometheus_file", type=str, default=None, help = "Keep the live counters in this file in the Prometheus text format, e.g. for node_exporter's textfile collector")
+    parser.add_argument("--status_interval", type=float, default=1.0, help = "Seconds between updates of --dashboard and --prometheus_file")
+    parser.add_argument("--metrics_file", type=str, default=None, help = "Per-request metrics sidecar JSONL (default: <output_file_name>.metrics.jsonl)")
+    args = parser.parse_args(argv)
+    n_files = len(args.input_file_name or [])
+    if len(args.output_file_name or []) != n_files:
+        parser.error("--output_file_name needs one file per --input_file_name")
+    if args.dead_letter_file is not None and n_files > 1:
+        parser.error("--dead_letter_file only works with a single input file")
+    args.priorities = args.priorities or [0] * n_files
+    args.weights = args.weights or [1.0] * n_files
+    if len(args.priorities) != n_files or len(args.weights) != n_files:
+        parser.error("--priorities and --weights need one value per --input_file_name")
+    if any(weight <= 0 for weight in args.weights):
+        parser.error("--weights must be positive")
+    if args.shard is not None:
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.hedge and not args.async_mode:
+        parser.error("--hedge requires --async_mode: joblib workers cannot cancel the losing request")
     return args
 
+def run_dispatch(args, provider_config, jobs):
+    """
+    Dispatches `jobs` with the configured engine, writing each job's results
+    to its output file and its failed requests to its dead-letter file,
+    then reports cache and metrics statistics. Returns the number of failed
+    requests.
+    """
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+
+    metrics_file = args.metrics_file or f"{args.output_file_name[0]}.metrics.jsonl"
+    metrics = MetricsRecorder(metrics_file, append = args.resume or args.retry_failed)
+    total = sum(job.total for job in jobs)
+    started_at = time.monotonic()
+    dashboard = Dashboard(total, display = args.dashboard, prometheus_file = args.prometheus_file,
+                          interval = args.status_interval).start()
+
+    with contextlib.ExitStack() as stack:
+        stack.callback(dashboard.stop)
+        for job in jobs:
+            job.writer = stack.enter_context(JsonlResultWriter(job.output_file_name, append = job.append, fsync_every = args.fsync_every))
+            job.dead_letter = stack.enter_context(JsonlResultWriter(job.dead_letter_file, fsync_every = args.fsync_every))
+        if args.async_mode:
+            controllers = asyncio.run(dispatch_async(jobs, args.max_concurrency, cache, provider_config,
+                                                     args.adaptive, args.initial_concurrency, metrics,
+                                                     args.lookahead, total, args.hedge, args.hedge_percentile,
+                                                     args.hedge_budget, args.output_order, dashboard))
+            for provider, controller in controllers.items():
+                logger.info(f"Adaptive concurrency [{provider}]: {controller.summary()}")
+        else:
+            dispatch_joblib(jobs, args.n_jobs, cache, metrics, total, args.output_order, dashboard)
+
+    failed = 0
+    for job in jobs:
+        if len(jobs) > 1 and job.finished_at is not None:
+            logger.info(f"{job.input_file_name} (priority {job.priority}, weight {job.weight:g}): "
+                        f"{job.results} requests done after {job.finished_at - started_at:.1f}s")
+        if job.dead_letter.written:
+            logger.warning(f"{job.dead_letter.written} requests failed, see {job.dead_letter_file}")
+        failed += job.dead_letter.written
+    if key_pool_summary():
+        logger.info(f"API keys: {key_pool_summary()}")
+    if circuit_breaker_summary():
+        logger.info(f"Circuit breakers opened: {circuit_breaker_summary()}")
+    if cache is not None:
+        logger.info(f"Response cache: {cache.stats()}")
+
+    metrics.close()
+    summary = metrics.summary()
+    with open(f"{os.path.splitext(metrics_file)[0]}.summary.json", 'w') as f:
+        json.dump(summary, f, indent = 4)
+    metrics.print_summary(summary)
+    return failed
+
+
+def job_files(args):
+    """Yields (input file, output file, dead-letter file) for each input file."""
+    for input_file_name, output_file_name in zip(args.input_file_name, args.output_file_name):
+        yield input_file_name, output_file_name, args.dead_letter_file or f"{output_file_name}.dead_letter.jsonl"
+
+
+def retry_failed(args, provider_config):
+    """
+    Re-sends the requests in the dead-letter files and splices the ones that
+    succeed into their output files, in input order unless the output is in
+    completion order. Requests that fail again replace the dead-letter files.
+    """
+    files = list(job_files(args))
+    jobs = []
+    for idx, (input_file_name, output_file_name, dead_letter_file) in enumerate(files):
+        if not os.path.exists(dead_letter_file):
+            logger.info(f"No dead-letter file at {dead_letter_file}, nothing to retry")
+            continue
+        data = (entry['request'] for entry in read_jsonl(dead_letter_file))
+        jobs.append(Job(idx, input_file_name, data, f"{output_file_name}.retry.jsonl", f"{dead_letter_file}.retry",
+                        count_lines(dead_letter_file), weight = args.weights[idx], priority = args.priorities[idx]))
+    if not jobs:
+        return
+    run_dispatch(args, provider_config, jobs)
+
+    for job in jobs:
+        _, output_file_name, dead_letter_file = files[job.idx]
+        results = {result['custom_id']: result for result in read_jsonl(job.output_file_name)}
+        #an output in completion order has no positions to keep, so results are appended
+        spliced = splice_results(output_file_name, results, job.input_file_name if args.output_order == 'input' else None)
+        os.replace(job.dead_letter_file, dead_letter_file)
+        os.remove(job.output_file_name)
+        logger.info(f"Retried {job.total} failed requests: {spliced} spliced into {output_file_name}, "
+                    f"{job.dead_letter.written} still failing")
+
+
 def main(args):
-    data = read_jsonl(args.input_file_name)
-    
-    #check the model type
-    if data[0]['body']['model'] in ['gpt-4', 'gpt-4-turbo', 'gpt-3.5-turbo-0125', 'gpt-4o']:
-        results = Parallel(n_jobs = args.n_jobs)(delayed(backoff_openai_call)(data_dict) for data_dict in tqdm(data))
-        write_jsonl(args.output_file_name, results)
-    elif data[0]['body']['model'] in ['llama3-70b']:
-        results = Parallel(n_jobs = args.n_jobs)(delayed(backoff_llama3_call)(data_dict) for data_dict in tqdm(data))
-        write_jsonl(args.output_file_name, results)
-    elif data[0]['body']['model'] in ['claude3-opus']:
-        results = Parallel(n_jobs = args.n_jobs)(delayed(backoff_claude_call)(data_dict) for data_dict in tqdm(data))
-        write_jsonl(args.output_file_name, results)
-    elif data[0]['body']['model'] in ['gemini-1.5-flash', 'gemini-1.5-pro']:
-        results = Parallel(n_jobs = args.n_jobs)(delayed(backoff_gemini_call)(data_dict) for data_dict in tqdm(data))
-        write_jsonl(args.output_file_name, results)
-    else:
-        print("Still pending")
+    provider_config = load_provider_config(args.provider_config)
+    configure_rate_limits(provider_config, args.rpm, args.tpm)
+    configure_key_pools(provider_config, args.key_strategy, args.key_cooldown)
+    configure_circuit_breakers(provider_config, args.breaker_failures, args.breaker_timeout)
+    configure_run_limits(provider_config, args.request_timeout, args.max_tries, args.retry_budget, args.deadline)
+
+    if args.retry_failed:
+        retry_failed(args, provider_config)
+        return
+
+    jobs = []
+    for idx, (input_file_name, output_file_name, dead_letter_file) in enumerate(job_files(args)):
+        data = read_jsonl(input_file_name)
+        #counting lines is cheap next to parsing them and gives the progress bar a total
+        total = count_lines(input_file_name)
+
+        if args.shard is not None:
+            index, n_shards = args.shard
+            data = in_shard(data, index, n_shards)
+            total = -(-total // n_shards)
+            logger.info(f"Shard {index}/{n_shards} of {input_file_name}: about {total} requests")
+
+        #failed requests are missing from the output, so they are dispatched again
+        if args.resume:
+            finished_ids = prepare_resume(output_file_name)
+            data = (data_dict for data_dict in data if data_dict['custom_id'] not in finished_ids)
+            total = max(0, total - len(finished_ids))
+            logger.info(f"Resuming {input_file_name}: {len(finished_ids)} finished, about {total} remaining")
+
+        jobs.append(Job(idx, input_file_name, data, output_file_name, dead_letter_file, total, append = args.resume,
+                        weight = args.weights[idx], priority = args.priorities[idx]))
+
+    run_dispatch(args, provider_config, jobs)
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
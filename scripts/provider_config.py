@@ -0,0 +1,35 @@
+import json
+
+
+def load_provider_config(file_name):
+    """
+    Loads the per-provider dispatch settings used by parallel_call.py.
+
+    The file maps a provider name ('openai', 'llama3', 'claude', 'gemini') to
+    its settings. Any setting can be overridden for a single model under
+    "models", e.g.
+
+        {
+            "openai": {"rpm": 5000, "tpm": 800000,
+                       "models": {"gpt-4o": {"rpm": 500, "tpm": 30000}}},
+            "claude": {"rpm": 50, "tpm": 40000}
+        }
+
+    Returns an empty config when no file is given.
+    """
+    if file_name is None:
+        return {}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def get_provider_setting(config, provider, model, key, default=None):
+    """
+    Looks up a setting for (provider, model): the model override wins over
+    the provider setting, which wins over `default`.
+    """
+    provider_config = config.get(provider, {})
+    model_config = provider_config.get('models', {}).get(model, {})
+    if key in model_config:
+        return model_config[key]
+    return provider_config.get(key, default)
@@ -0,0 +1,140 @@
+import time
+import asyncio
+import threading
+from provider_config import get_provider_setting
+
+
+# Rough characters-per-token ratio for English prompts. It only needs to be
+# close enough to meter dispatch; the provider's own count is authoritative.
+CHARS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+
+_RATE_LIMIT_CONFIG = {}
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def estimate_tokens(body):
+    """
+    Estimates the tokens a request counts against the tokens/min quota:
+    the prompt built from `body['messages']` plus the `max_tokens` the
+    provider reserves for the completion.
+    """
+    prompt_tokens = 0
+    for message in body['messages']:
+        prompt_tokens += TOKENS_PER_MESSAGE + len(message['content']) // CHARS_PER_TOKEN
+    return prompt_tokens + body.get('max_tokens', 0)
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously at `rate_per_minute`.
+
+    `reserve` always takes the tokens, letting the balance go negative, and
+    returns how long the caller has to wait before the debt is repaid. This
+    keeps callers in FIFO order and lets requests larger than the bucket
+    through at the sustained rate instead of blocking forever. `clock`
+    returns the current time in seconds (time.monotonic by default).
+    """
+
+    def __init__(self, rate_per_minute, burst_seconds=1.0, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """
+    Meters dispatch against separate requests/min and tokens/min budgets.
+    Either budget may be None, in which case it is not enforced.
+    """
+
+    def __init__(self, rpm=None, tpm=None, headroom=0.95):
+        self.request_bucket = TokenBucket(rpm * headroom) if rpm else None
+        self.token_bucket = TokenBucket(tpm * headroom) if tpm else None
+
+    def reserve(self, n_tokens):
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.reserve(n_tokens))
+        return wait
+
+    def acquire(self, n_tokens):
+        wait = self.reserve(n_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, n_tokens):
+        wait = self.reserve(n_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def configure_rate_limits(config, default_rpm=None, default_tpm=None, headroom=0.95):
+    """
+    Sets the limits used by `get_rate_limiter`. `config` is a provider config
+    (see provider_config.py) whose "rpm"/"tpm" settings override the defaults.
+    """
+    _RATE_LIMIT_CONFIG.clear()
+    _RATE_LIMIT_CONFIG.update({
+        'config': config,
+        'default_rpm': default_rpm,
+        'default_tpm': default_tpm,
+        'headroom': headroom
+    })
+    _RATE_LIMITERS.clear()
+
+
+def get_rate_limiter(provider, model, key = None):
+    """
+    Returns the shared limiter for (provider, model) and, with a key pool,
+    the ApiKey (see key_pool.py) the request is sent with: each key has its
+    own quota, taken from the key's rpm/tpm if set. Returns None when
+    neither a requests/min nor a tokens/min budget is configured for it.
+    """
+    cache_key = (provider, model, key.label if key is not None else None)
+    if cache_key in _RATE_LIMITERS:
+        return _RATE_LIMITERS[cache_key]
+
+    with _RATE_LIMITERS_LOCK:
+        if cache_key not in _RATE_LIMITERS:
+            config = _RATE_LIMIT_CONFIG.get('config', {})
+            rpm = get_provider_setting(config, provider, model, 'rpm', _RATE_LIMIT_CONFIG.get('default_rpm'))
+            tpm = get_provider_setting(config, provider, model, 'tpm', _RATE_LIMIT_CONFIG.get('default_tpm'))
+            if key is not None:
+                rpm = key.rpm or rpm
+                tpm = key.tpm or tpm
+            if rpm or tpm:
+                _RATE_LIMITERS[cache_key] = RateLimiter(rpm, tpm, _RATE_LIMIT_CONFIG.get('headroom', 0.95))
+            else:
+                _RATE_LIMITERS[cache_key] = None
+    return _RATE_LIMITERS[cache_key]
+
+
+def rate_limits_configured():
+    config = _RATE_LIMIT_CONFIG.get('config', {})
+    if _RATE_LIMIT_CONFIG.get('default_rpm') or _RATE_LIMIT_CONFIG.get('default_tpm'):
+        return True
+    for provider_config in config.values():
+        for settings in [provider_config] + list(provider_config.get('models', {}).values()):
+            if settings.get('rpm') or settings.get('tpm'):
+                return True
+        for entry in provider_config.get('api_keys', []):
+            if isinstance(entry, dict) and (entry.get('rpm') or entry.get('tpm')):
+                return True
+    return False
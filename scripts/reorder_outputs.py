@@ -0,0 +1,38 @@
+import argparse
+from merge_shards import merge_shards
+
+
+def reorder(input_file_name, output_file_name, reordered_file_name=None):
+    """
+    Rewrites an output written with `--output_order completion` in the
+    order of `input_file_name`, in place unless `reordered_file_name` is
+    given. Only a custom_id -> byte offset index is held in memory. Lines
+    whose custom_id is not in the input are kept at the end. Returns the
+    counts of merge_shards.
+    """
+    return merge_shards(input_file_name, [output_file_name], reordered_file_name or output_file_name, keep_unknown=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Put the results of a parallel_call.py --output_order completion run back in input order')
+    parser.add_argument('--input_file_name', type=str, required=True, help='Input file of the run')
+    parser.add_argument('--output_file_name', type=str, required=True, help='Output file of the run')
+    parser.add_argument('--reordered_file_name', type=str, default=None, help='Write the reordered results here instead of replacing the output file')
+    return parser.parse_args()
+
+def main(args):
+    merged, gaps, duplicates, unknown, unreadable = reorder(args.input_file_name, args.output_file_name, args.reordered_file_name)
+    print(f"Reordered results: {merged}")
+    #failed requests are in the dead-letter file, so missing results are expected
+    print(f"Requests without a result: {len(gaps)}")
+    if unknown:
+        print(f"Results not in the input (kept at the end): {len(unknown)}")
+    if duplicates:
+        print(f"Duplicate results (kept the first): {len(duplicates)}")
+    if unreadable:
+        print(f"Unreadable lines (skipped): {unreadable}")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,226 @@
+import json
+import time
+import random
+import threading
+
+
+# Estimated list prices in USD per 1M (prompt, completion) tokens. The hosted
+# Llama3 price depends on the provider behind LLAMA3_BASE_URL.
+MODEL_PRICING = {
+    'gpt-4o': (5.0, 15.0),
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4': (30.0, 60.0),
+    'gpt-3.5-turbo-0125': (0.5, 1.5),
+    'claude3-opus': (15.0, 75.0),
+    'gemini-1.5-pro': (3.5, 10.5),
+    'gemini-1.5-flash': (0.35, 1.05),
+    'llama3-70b': (0.9, 0.9)
+}
+
+# backoff's on_success handler stores the number of tries of the call that
+# just finished here, so the sync path can report retries per request.
+_LAST_TRIES = threading.local()
+
+
+def record_tries(details):
+    _LAST_TRIES.value = details['tries']
+
+def pop_last_tries():
+    tries = getattr(_LAST_TRIES, 'value', 1)
+    _LAST_TRIES.value = 1
+    return tries
+
+# Likewise the number of attempts of the current sync call answered with a 429.
+_RATE_LIMITED = threading.local()
+
+def count_rate_limited():
+    _RATE_LIMITED.value = getattr(_RATE_LIMITED, 'value', 0) + 1
+
+def pop_rate_limited():
+    rate_limited = getattr(_RATE_LIMITED, 'value', 0)
+    _RATE_LIMITED.value = 0
+    return rate_limited
+
+
+def extract_usage(result):
+    """
+    Returns (prompt_tokens, completion_tokens) from a result, accepting both
+    the OpenAI (prompt/completion) and Anthropic (input/output) usage shapes.
+    """
+    if result is None or result.get('error') is not None:
+        return 0, 0
+    usage = result.get('response', {}).get('body', {}).get('usage') or {}
+    prompt_tokens = usage.get('prompt_tokens', usage.get('input_tokens', 0)) or 0
+    completion_tokens = usage.get('completion_tokens', usage.get('output_tokens', 0)) or 0
+    return prompt_tokens, completion_tokens
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    if model not in MODEL_PRICING:
+        return None
+    prompt_price, completion_price = MODEL_PRICING[model]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+class Reservoir:
+    """
+    Uniform random sample of at most `size` values out of a stream
+    (Vitter's algorithm R), plus the exact count and sum, so percentiles over
+    arbitrarily many requests use bounded memory.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.values = []
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            slot = random.randrange(self.count)
+            if slot < self.size:
+                self.values[slot] = value
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class MetricsRecorder:
+    """
+    Writes one line per finished request to a metrics sidecar JSONL (wall
+    time, queue wait, attempts, 429s, tokens and provider-reported usage)
+    and keeps per-model aggregates for the end-of-run summary.
+
+    Cached results are recorded with `cached` set; they count towards
+    throughput but not towards latency, tokens or cost. Latency percentiles
+    are computed over a fixed-size random sample of the requests.
+    """
+
+    def __init__(self, file_name, append=False):
+        self.f = open(file_name, 'a' if append else 'w')
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.models = dict()
+
+    def _model_stats(self, model):
+        if model not in self.models:
+            self.models[model] = {
+                'requests': 0, 'errors': 0, 'cached': 0, 'retries': 0, 'hedges': 0, 'rate_limited': 0,
+                'prompt_tokens': 0, 'completion_tokens': 0,
+                'wall_times': Reservoir(), 'queue_waits': Reservoir()
+            }
+        return self.models[model]
+
+    def record(self, data_dict, provider, result, wall_time=0.0, queue_wait=0.0, attempts=1, cached=False, hedged=False,
+               rate_limited=0):
+        model = data_dict['body']['model']
+        prompt_tokens, completion_tokens = extract_usage(result)
+        #a hedge is an extra attempt but not a retry
+        retries = max(0, attempts - 1 - int(hedged))
+        error = result.get('error') if result is not None else 'no result'
+        usage = None
+        if error is None:
+            usage = result.get('response', {}).get('body', {}).get('usage')
+        entry = {
+            'custom_id': data_dict['custom_id'],
+            'model': model,
+            'provider': provider,
+            'cached': cached,
+            'wall_time': round(wall_time, 4),
+            'queue_wait': round(queue_wait, 4),
+            'attempts': attempts,
+            'retries': retries,
+            'hedged': hedged,
+            'rate_limited': rate_limited,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'usage': usage,
+            'error': error
+        }
+        with self.lock:
+            self.f.write(json.dumps(entry) + '\n')
+            stats = self._model_stats(model)
+            stats['requests'] += 1
+            if error is not None:
+                stats['errors'] += 1
+            if cached:
+                stats['cached'] += 1
+                return
+            stats['retries'] += retries
+            stats['hedges'] += int(hedged)
+            stats['rate_limited'] += rate_limited
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+            stats['wall_times'].add(wall_time)
+            stats['queue_waits'].add(queue_wait)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        models = dict()
+        all_wall_times = []
+        totals = {'requests': 0, 'errors': 0, 'cached': 0, 'retries': 0, 'hedges': 0, 'rate_limited': 0,
+                  'prompt_tokens': 0, 'completion_tokens': 0, 'estimated_cost_usd': 0.0}
+        for model, stats in self.models.items():
+            cost = estimate_cost(model, stats['prompt_tokens'], stats['completion_tokens'])
+            wall_times = stats['wall_times'].values
+            models[model] = {
+                'requests': stats['requests'],
+                'errors': stats['errors'],
+                'cached': stats['cached'],
+                'retries': stats['retries'],
+                'hedges': stats['hedges'],
+                'rate_limited': stats['rate_limited'],
+                'latency_p50': percentile(wall_times, 50),
+                'latency_p95': percentile(wall_times, 95),
+                'latency_p99': percentile(wall_times, 99),
+                'queue_wait_mean': stats['queue_waits'].mean(),
+                'prompt_tokens': stats['prompt_tokens'],
+                'completion_tokens': stats['completion_tokens'],
+                'estimated_cost_usd': cost
+            }
+            all_wall_times.extend(wall_times)
+            for key in ['requests', 'errors', 'cached', 'retries', 'hedges', 'rate_limited', 'prompt_tokens', 'completion_tokens']:
+                totals[key] += stats[key]
+            totals['estimated_cost_usd'] += cost or 0.0
+
+        totals.update({
+            'elapsed_s': elapsed,
+            'requests_per_s': totals['requests'] / elapsed if elapsed > 0 else 0.0,
+            'tokens_per_s': (totals['prompt_tokens'] + totals['completion_tokens']) / elapsed if elapsed > 0 else 0.0,
+            'latency_p50': percentile(all_wall_times, 50),
+            'latency_p95': percentile(all_wall_times, 95),
+            'latency_p99': percentile(all_wall_times, 99)
+        })
+        return {'total': totals, 'models': models}
+
+    def print_summary(self, summary=None):
+        summary = summary or self.summary()
+        total = summary['total']
+
+        def fmt(seconds):
+            return f"{seconds:.2f}s" if seconds is not None else "n/a"
+
+        print(f"Requests: {total['requests']} ({total['cached']} cached, {total['errors']} errors, {total['retries']} retries, {total['hedges']} hedged) "
+              f"in {total['elapsed_s']:.1f}s = {total['requests_per_s']:.1f} req/s, {total['tokens_per_s']:.0f} tokens/s")
+        print(f"Latency p50/p95/p99: {fmt(total['latency_p50'])} / {fmt(total['latency_p95'])} / {fmt(total['latency_p99'])}")
+        for model, stats in summary['models'].items():
+            cost = f"${stats['estimated_cost_usd']:.2f}" if stats['estimated_cost_usd'] is not None else "unknown"
+            print(f"  {model}: {stats['requests']} requests, p50/p95/p99 {fmt(stats['latency_p50'])} / "
+                  f"{fmt(stats['latency_p95'])} / {fmt(stats['latency_p99'])}, "
+                  f"{stats['prompt_tokens']} prompt + {stats['completion_tokens']} completion tokens, est. cost {cost}")
+        print(f"Estimated total cost: ${total['estimated_cost_usd']:.2f}")
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
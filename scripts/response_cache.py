@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+def canonical_body(body):
+    """
+    Serializes a request body deterministically: keys are sorted and no
+    whitespace is emitted, so equal bodies always give the same bytes.
+    """
+    return json.dumps(body, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def request_hash(body):
+    """
+    Content address of a request: the SHA-256 of its canonical body (model,
+    messages, temperature, max_tokens and any other sampling parameters).
+    """
+    return hashlib.sha256(canonical_body(body).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk cache of successful responses, keyed by `request_hash`.
+
+    Only deterministic requests (temperature 0) are cached. Each entry is one
+    file under `cache_dir/<first two hex chars>/`; reading an entry bumps its
+    mtime, and when the cache grows past `max_bytes` the least recently used
+    entries are deleted.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.entries = dict()
+        self.total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        for prefix in os.scandir(self.cache_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                stat = entry.stat()
+                self.entries[entry.path] = (stat.st_size, stat.st_mtime)
+                self.total_bytes += stat.st_size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def cacheable(self, body):
+        return body.get('temperature') == 0
+
+    def get(self, data_dict):
+        """
+        Returns the cached result for a request, re-labelled with its
+        custom_id, or None on a miss.
+        """
+        body = data_dict['body']
+        if not self.cacheable(body):
+            return None
+        path = self._path(request_hash(body))
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+            if path in self.entries:
+                self.entries[path] = (self.entries[path][0], now)
+        result['custom_id'] = data_dict['custom_id']
+        return result
+
+    def put(self, data_dict, result):
+        body = data_dict['body']
+        if not self.cacheable(body) or result is None or result.get('error') is not None:
+            return
+        path = self._path(request_hash(body))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        with self.lock:
+            if path in self.entries:
+                self.total_bytes -= self.entries[path][0]
+            self.entries[path] = (size, time.time())
+            self.total_bytes += size
+            self.stores += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        #drop least recently used entries until we are back under 90% of the limit
+        target = 0.9 * self.max_bytes
+        for path, (size, _) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del self.entries[path]
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'size_mb': self.total_bytes / (1024 * 1024)
+        }
@@ -0,0 +1,166 @@
+import io
+import os
+import json
+import time
+from jsonl_stream import read_jsonl
+
+
+class JsonlResultWriter:
+    """
+    Appends results to a JSONL file as they complete.
+
+    Lines are flushed and fsync'ed in batches, every `fsync_every` results or
+    `fsync_interval` seconds, whichever comes first. A crash therefore loses
+    at most one batch, and only completed lines reach the file.
+    """
+
+    def __init__(self, file_name, append=False, fsync_every=100, fsync_interval=5.0):
+        self.file_name = file_name
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.f = open(file_name, 'a' if append else 'w')
+        self.pending = 0
+        self.written = 0
+        self.last_sync = time.monotonic()
+
+    def write(self, result):
+        self.f.write(json.dumps(result) + '\n')
+        self.pending += 1
+        self.written += 1
+        if self.pending >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class OrderedResultWriter:
+    """
+    Wraps a writer so results submitted out of order are written in input
+    order: a result is held back until every earlier index has been written.
+    A None result holds its index but writes nothing.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.next_idx = 0
+        self.buffer = dict()
+
+    def write(self, idx, result):
+        self.buffer[idx] = result
+        while self.next_idx in self.buffer:
+            result = self.buffer.pop(self.next_idx)
+            if result is not None:
+                self.writer.write(result)
+            self.next_idx += 1
+
+
+class CompletionResultWriter:
+    """
+    Stands in for OrderedResultWriter when results are written in the order
+    they complete: each one is written as soon as it arrives. `next_idx`
+    counts the results received, so `idx - next_idx` is still the number of
+    requests read but not finished.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.next_idx = 0
+
+    def write(self, idx, result):
+        if result is not None:
+            self.writer.write(result)
+        self.next_idx += 1
+
+
+def prepare_resume(file_name):
+    """
+    Prepares an existing output file for `--resume`.
+
+    Keeps only successful results, dropping error entries and a line
+    truncated by a crash, so they are dispatched again. The file is rewritten
+    atomically. Returns the set of finished custom_ids.
+    """
+    finished_ids = set()
+    if not os.path.exists(file_name):
+        return finished_ids
+
+    tmp_file_name = file_name + '.tmp'
+    with open(file_name) as f, open(tmp_file_name, 'w') as out:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get('error') is not None or result.get('custom_id') in finished_ids:
+                continue
+            finished_ids.add(result['custom_id'])
+            out.write(json.dumps(result) + '\n')
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_file_name, file_name)
+    return finished_ids
+
+
+def splice_results(file_name, results, input_file_name=None):
+    """
+    Merges `results` (by custom_id) into an existing output file, which is
+    rewritten atomically. Existing lines are copied unchanged, except those
+    with the custom_id of a result, which the result replaces.
+
+    With `input_file_name`, each result is placed where its request is in
+    the input; this streams both files, so only `results` are held in
+    memory. Lines out of input order (e.g. appended by `--resume`) and
+    results without an input position are appended at the end. Returns the
+    number of results spliced in.
+    """
+    results = dict(results)
+    replaced = set()
+    spliced = 0
+    tmp_file_name = file_name + '.tmp'
+    existing = open(file_name) if os.path.exists(file_name) else io.StringIO()
+    with existing, open(tmp_file_name, 'w') as out:
+        lines = (line if line.endswith('\n') else line + '\n' for line in existing if line.strip())
+        line = next(lines, None)
+        if input_file_name is not None:
+            for data_dict in read_jsonl(input_file_name):
+                custom_id = data_dict['custom_id']
+                in_place = line is not None and json.loads(line).get('custom_id') == custom_id
+                if custom_id in results:
+                    out.write(json.dumps(results.pop(custom_id)) + '\n')
+                    replaced.add(custom_id)
+                    spliced += 1
+                elif in_place:
+                    out.write(line)
+                if in_place:
+                    line = next(lines, None)
+        while line is not None:
+            custom_id = json.loads(line).get('custom_id')
+            if custom_id in results:
+                out.write(json.dumps(results.pop(custom_id)) + '\n')
+                replaced.add(custom_id)
+                spliced += 1
+            elif custom_id not in replaced:
+                out.write(line)
+            line = next(lines, None)
+        for result in results.values():
+            out.write(json.dumps(result) + '\n')
+            spliced += 1
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_file_name, file_name)
+    return spliced
@@ -0,0 +1,202 @@
+import time
+import functools
+import threading
+from provider_config import get_provider_setting
+from request_metrics import record_tries
+
+
+DEFAULT_REQUEST_TIMEOUT = 600.0
+DEFAULT_MAX_TRIES = 10
+
+# Settings by name, the run deadline and the shared retry budgets by provider.
+_LIMITS_CONFIG = dict()
+_RETRY_BUDGETS = dict()
+_RETRY_BUDGETS_LOCK = threading.Lock()
+
+# backoff's on_giveup handler stores why the sync call that just finished
+# gave up here, so it can be sent to the dead-letter file.
+_LAST_GIVEUP = threading.local()
+# The model and failed attempts of the sync request running on this thread.
+_SYNC_REQUEST = threading.local()
+
+
+class RetryBudget:
+    """
+    Caps retries at `ratio` times the requests started, plus `min_retries`
+    so the first requests of a run can retry too. A `ratio` of None never
+    runs out.
+    """
+
+    def __init__(self, ratio=None, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def on_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def try_spend(self):
+        if self.ratio is None:
+            return True
+        with self.lock:
+            if self.retries + 1 > self.ratio * self.requests + self.min_retries:
+                return False
+            self.retries += 1
+            return True
+
+
+def configure_run_limits(config, request_timeout=DEFAULT_REQUEST_TIMEOUT, max_tries=DEFAULT_MAX_TRIES,
+                         retry_budget=None, deadline=None):
+    """
+    Sets the defaults for the per-attempt timeout, the attempts per request
+    and the retry budget; "request_timeout", "max_tries" and "retry_budget"
+    in the provider config (see provider_config.py) override them. `deadline`
+    is the number of seconds from now after which no attempt is started.
+    """
+    _LIMITS_CONFIG.clear()
+    _LIMITS_CONFIG.update({
+        'config': config,
+        'request_timeout': request_timeout,
+        'max_tries': max_tries,
+        'retry_budget': retry_budget,
+        'deadline': time.monotonic() + deadline if deadline is not None else None
+    })
+    _RETRY_BUDGETS.clear()
+
+
+def _setting(provider, model, key, default):
+    return get_provider_setting(_LIMITS_CONFIG.get('config', {}), provider, model, key, _LIMITS_CONFIG.get(key, default))
+
+
+def time_left():
+    """Seconds until the run deadline, or None without one."""
+    deadline = _LIMITS_CONFIG.get('deadline')
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+def deadline_passed():
+    return time_left() == 0.0
+
+
+def attempt_timeout(provider, model):
+    """Timeout for one attempt: the request timeout, cut short by the run deadline."""
+    timeout = _setting(provider, model, 'request_timeout', DEFAULT_REQUEST_TIMEOUT)
+    remaining = time_left()
+    if remaining is not None:
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return timeout
+
+def get_max_tries(provider, model=None):
+    return _setting(provider, model, 'max_tries', DEFAULT_MAX_TRIES)
+
+
+def get_retry_budget(provider):
+    if provider in _RETRY_BUDGETS:
+        return _RETRY_BUDGETS[provider]
+    with _RETRY_BUDGETS_LOCK:
+        if provider not in _RETRY_BUDGETS:
+            _RETRY_BUDGETS[provider] = RetryBudget(_setting(provider, None, 'retry_budget', None))
+    return _RETRY_BUDGETS[provider]
+
+
+def give_up_reason(provider, model, attempts):
+    """
+    Returns why a failed request should not be retried ("deadline",
+    "max_tries" or "retry_budget"), or None if it may be retried. A retry
+    that is allowed is charged to the provider's budget.
+    """
+    if deadline_passed():
+        return 'deadline'
+    max_tries = get_max_tries(provider, model)
+    if max_tries is not None and attempts >= max_tries:
+        return 'max_tries'
+    if not get_retry_budget(provider).try_spend():
+        return 'retry_budget'
+    return None
+
+
+def run_limits_configured():
+    """True if any limit differs from the defaults."""
+    if _LIMITS_CONFIG.get('deadline') is not None or _LIMITS_CONFIG.get('retry_budget') is not None:
+        return True
+    if _LIMITS_CONFIG.get('request_timeout', DEFAULT_REQUEST_TIMEOUT) != DEFAULT_REQUEST_TIMEOUT:
+        return True
+    if _LIMITS_CONFIG.get('max_tries', DEFAULT_MAX_TRIES) != DEFAULT_MAX_TRIES:
+        return True
+    for provider_config in _LIMITS_CONFIG.get('config', {}).values():
+        for settings in [provider_config] + list(provider_config.get('models', {}).values()):
+            if any(key in settings for key in ['request_timeout', 'max_tries', 'retry_budget']):
+                return True
+    return False
+
+
+def start_sync_request(provider, model):
+    """
+    Counts a sync request towards its provider's retry budget and notes its
+    model, so the retries of the call that follows on this thread are
+    checked against that model's limits.
+    """
+    _SYNC_REQUEST.model = model
+    _SYNC_REQUEST.attempts = 0
+    _SYNC_REQUEST.reason = None
+    get_retry_budget(provider).on_request()
+
+def failed_sync_attempts():
+    """Failed attempts so far of the sync request running on this thread."""
+    return getattr(_SYNC_REQUEST, 'attempts', 0)
+
+def _give_up(provider, e):
+    #backoff calls this once for every failed attempt, before anything else
+    _SYNC_REQUEST.attempts = getattr(_SYNC_REQUEST, 'attempts', 0) + 1
+    _SYNC_REQUEST.reason = give_up_reason(provider, getattr(_SYNC_REQUEST, 'model', None), _SYNC_REQUEST.attempts)
+    return _SYNC_REQUEST.reason is not None
+
+def _record_giveup(provider, details):
+    #backoff also gives up by itself once max_time has passed
+    reason = getattr(_SYNC_REQUEST, 'reason', None) or 'deadline'
+    error_type = type(details['exception']).__name__
+    _LAST_GIVEUP.value = (reason, str(details['exception']) or error_type, error_type)
+
+def backoff_limits(provider):
+    """
+    Keyword arguments for `backoff.on_exception` that apply the run limits
+    to a provider's sync calls, like `give_up_reason` does for async ones.
+    Call `start_sync_request` before each call. On giving up the call
+    returns None and the reason is kept for `pop_giveup_reason`.
+    """
+    #partials of module functions, unlike closures, pickle by reference, so
+    #joblib can still send the decorated calls to worker processes
+    return {
+        'max_value': 60,
+        'max_tries': None,
+        'max_time': time_left,
+        'giveup': functools.partial(_give_up, provider),
+        'on_giveup': [record_tries, functools.partial(_record_giveup, provider)],
+        'raise_on_giveup': False
+    }
+
+def pop_giveup_reason():
+    """Returns (reason, error message, error class) for the sync call that just gave up, or None."""
+    reason = getattr(_LAST_GIVEUP, 'value', None)
+    _LAST_GIVEUP.value = None
+    return reason
+
+
+def dead_letter_entry(data_dict, result, reason=None, attempts=0):
+    """
+    Dead-letter line for a failed request: the original request, the error
+    and its class, and why it was not retried further ("error" if it failed
+    with an error that is not retried).
+    """
+    return {
+        'custom_id': data_dict['custom_id'],
+        'reason': reason or 'error',
+        'error': result['error'],
+        'error_type': result.get('error_type'),
+        'attempts': attempts,
+        'request': data_dict
+    }
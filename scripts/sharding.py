@@ -0,0 +1,31 @@
+import hashlib
+
+
+def parse_shard(spec):
+    """
+    Parses a shard spec "i/N" into (i, N), with 0 <= i < N. Raises
+    ValueError on anything else.
+    """
+    index, sep, n_shards = spec.partition('/')
+    if not sep:
+        raise ValueError(f"Shard must look like i/N, got {spec!r}")
+    index, n_shards = int(index), int(n_shards)
+    if n_shards < 1 or not 0 <= index < n_shards:
+        raise ValueError(f"Shard index must be in [0, N), got {spec!r}")
+    return index, n_shards
+
+
+def shard_of(custom_id, n_shards):
+    """
+    Shard of a request: a hash of its custom_id that is stable across
+    processes, machines and Python versions (unlike the built-in `hash`).
+    """
+    digest = hashlib.sha1(str(custom_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % n_shards
+
+
+def in_shard(data, index, n_shards):
+    """Yields the requests of `data` that belong to shard `index` of `n_shards`."""
+    for data_dict in data:
+        if shard_of(data_dict['custom_id'], n_shards) == index:
+            yield data_dict
@@ -0,0 +1,94 @@
+import pytest
+from conftest import FakeClock
+from circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker('test', failure_threshold=3, reset_timeout=10.0, max_reset_timeout=25.0, clock=clock)
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.on_failure()
+    breaker.on_failure()
+    assert breaker.state == 'closed'
+    assert breaker.reserve() == 0.0
+    breaker.on_failure()
+    assert breaker.state == 'open'
+    assert breaker.reserve() == 10.0
+
+
+def test_success_resets_failure_count(breaker):
+    breaker.on_failure()
+    breaker.on_failure()
+    breaker.on_success()
+    breaker.on_failure()
+    breaker.on_failure()
+    assert breaker.state == 'closed'
+
+
+def test_half_open_probe_success_closes(breaker, clock):
+    for _ in range(3):
+        breaker.on_failure()
+    clock.advance(4.0)
+    assert breaker.reserve() == 6.0
+    clock.advance(6.0)
+    assert breaker.reserve() == 0.0
+    assert breaker.state == 'half_open'
+    #only the probe goes through until it reports back
+    assert breaker.reserve() == breaker.poll_interval
+    breaker.on_success()
+    assert breaker.state == 'closed'
+    assert breaker.failures == 0
+    assert breaker.reserve() == 0.0
+
+
+def test_half_open_probe_failure_reopens_with_doubled_timeout(breaker, clock):
+    for _ in range(3):
+        breaker.on_failure()
+    clock.advance(10.0)
+    assert breaker.reserve() == 0.0
+    breaker.on_failure()
+    assert breaker.state == 'open'
+    assert breaker.reserve() == 20.0
+    clock.advance(20.0)
+    assert breaker.reserve() == 0.0
+    breaker.on_failure()
+    #capped at max_reset_timeout
+    assert breaker.reserve() == 25.0
+    clock.advance(25.0)
+    breaker.reserve()
+    breaker.on_success()
+    assert breaker.reset_timeout == 10.0
+    assert breaker.times_opened == 3
+
+
+def test_lost_probe_is_replaced_after_reset_timeout(breaker, clock):
+    for _ in range(3):
+        breaker.on_failure()
+    clock.advance(10.0)
+    assert breaker.reserve() == 0.0
+    clock.advance(9.0)
+    assert breaker.reserve() == breaker.poll_interval
+    clock.advance(1.0)
+    assert breaker.reserve() == 0.0
+    assert breaker.state == 'half_open'
+
+
+def test_acquire_gives_up_at_max_wait(breaker):
+    for _ in range(3):
+        breaker.on_failure()
+    #the clock does not move, so the breaker stays open for the full reset_timeout
+    assert breaker.acquire(max_wait=0.0) is False
+
+
+def test_threshold_zero_disables(clock):
+    breaker = CircuitBreaker('test', failure_threshold=0, clock=clock)
+    for _ in range(100):
+        breaker.on_failure()
+    assert breaker.state == 'closed'
+    assert breaker.reserve() == 0.0
@@ -0,0 +1,66 @@
+import asyncio
+from fair_queue import Job, FairScheduler, FairQueue, interleave
+
+
+def make_job(idx, n_requests, weight=1.0, priority=0):
+    data = [{'custom_id': f"{idx}-{i}"} for i in range(n_requests)]
+    return Job(idx, f"in{idx}.jsonl", data, f"out{idx}.jsonl", f"out{idx}.jsonl.dead_letter.jsonl",
+               weight=weight, priority=priority)
+
+def order(pairs):
+    return [data_dict['custom_id'] for _, data_dict in pairs]
+
+
+def test_equal_weights_round_robin():
+    jobs = [make_job(0, 3), make_job(1, 3), make_job(2, 3)]
+    assert order(interleave(jobs, lambda data_dict: 1.0)) == ['0-0', '1-0', '2-0', '0-1', '1-1', '2-1', '0-2', '1-2', '2-2']
+
+
+def test_shorter_job_drops_out():
+    jobs = [make_job(0, 1), make_job(1, 3)]
+    assert order(interleave(jobs, lambda data_dict: 1.0)) == ['0-0', '1-0', '1-1', '1-2']
+
+
+def test_weights_share_in_proportion():
+    jobs = [make_job(0, 8, weight=2.0), make_job(1, 8)]
+    first = [job.idx for job, _ in interleave(jobs, lambda data_dict: 1.0)][:9]
+    assert first.count(0) == 6 and first.count(1) == 3
+
+
+def test_cost_counts_against_a_job():
+    jobs = [make_job(0, 4), make_job(1, 4)]
+    #job 0's requests cost three times as much
+    cost_fn = lambda data_dict: 3.0 if data_dict['custom_id'].startswith('0-') else 1.0
+    assert order(interleave(jobs, cost_fn))[:5] == ['0-0', '1-0', '1-1', '1-2', '0-1']
+
+
+def test_higher_priority_goes_first():
+    jobs = [make_job(0, 2), make_job(1, 2, priority=1)]
+    assert order(interleave(jobs, lambda data_dict: 1.0)) == ['1-0', '1-1', '0-0', '0-1']
+
+
+def test_idle_job_gets_no_credit():
+    scheduler = FairScheduler()
+    busy, idle = make_job(0, 0), make_job(1, 0)
+    for _ in range(5):
+        scheduler.charge(scheduler.pick([busy]))
+    #the idle job resumes at the current virtual time, so it alternates with the busy one
+    picks = []
+    for _ in range(4):
+        job = scheduler.pick([busy, idle])
+        scheduler.charge(job)
+        picks.append(job.idx)
+    assert picks == [1, 0, 1, 0]
+
+
+def test_fair_queue_get_order_and_close():
+    async def run():
+        queue = FairQueue()
+        jobs = [make_job(0, 0), make_job(1, 0)]
+        for i in range(2):
+            queue.put_nowait(jobs[0], f"0-{i}")
+        for i in range(2):
+            queue.put_nowait(jobs[1], f"1-{i}")
+        queue.close(2)
+        return [await queue.get() for _ in range(6)]
+    assert asyncio.run(run()) == ['0-0', '1-0', '0-1', '1-1', None, None]
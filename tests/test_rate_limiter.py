@@ -0,0 +1,54 @@
+import pytest
+from conftest import FakeClock
+from rate_limiter import TokenBucket
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_burst_up_to_capacity(clock):
+    #600/min is 10/s; a 2s burst allows 20 requests at once
+    bucket = TokenBucket(600, burst_seconds=2.0, clock=clock)
+    assert bucket.capacity == 20.0
+    assert [bucket.reserve(1) for _ in range(20)] == [0.0] * 20
+    assert bucket.reserve(1) == pytest.approx(0.1)
+
+
+def test_waits_grow_in_fifo_order(clock):
+    bucket = TokenBucket(600, clock=clock)
+    for _ in range(10):
+        bucket.reserve(1)
+    assert [bucket.reserve(1) for _ in range(3)] == pytest.approx([0.1, 0.2, 0.3])
+
+
+def test_refills_at_rate(clock):
+    bucket = TokenBucket(600, clock=clock)
+    for _ in range(10):
+        bucket.reserve(1)
+    clock.advance(0.5)
+    assert [bucket.reserve(1) for _ in range(5)] == [0.0] * 5
+    assert bucket.reserve(1) == pytest.approx(0.1)
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = TokenBucket(600, clock=clock)
+    clock.advance(3600)
+    assert [bucket.reserve(1) for _ in range(10)] == [0.0] * 10
+    assert bucket.reserve(1) == pytest.approx(0.1)
+
+
+def test_debt_is_repaid_before_new_requests(clock):
+    bucket = TokenBucket(60, clock=clock)
+    #a request larger than the bucket goes through, and the next caller waits for the debt
+    assert bucket.reserve(5) == pytest.approx(4.0)
+    clock.advance(4.0)
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+
+def test_small_rates_still_allow_one_request(clock):
+    bucket = TokenBucket(6, clock=clock)
+    assert bucket.capacity == 1.0
+    assert bucket.reserve(1) == 0.0
+    assert bucket.reserve(1) == pytest.approx(10.0)
@@ -0,0 +1,67 @@
+import json
+from result_writer import splice_results
+
+
+def write_jsonl(path, rows):
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+    return str(path)
+
+def read_ids(path):
+    with open(path) as f:
+        return [json.loads(line)['custom_id'] for line in f]
+
+def read_rows(path):
+    with open(path) as f:
+        return {row['custom_id']: row for row in map(json.loads, f)}
+
+
+def test_results_go_to_their_input_position(tmp_path):
+    input_file = write_jsonl(tmp_path / 'in.jsonl', [{'custom_id': str(i)} for i in range(6)])
+    output_file = write_jsonl(tmp_path / 'out.jsonl', [{'custom_id': i, 'answer': 'old'} for i in ['0', '2', '3', '5']])
+    spliced = splice_results(output_file, {'4': {'custom_id': '4'}, '1': {'custom_id': '1'}}, input_file)
+    assert spliced == 2
+    assert read_ids(output_file) == ['0', '1', '2', '3', '4', '5']
+
+
+def test_duplicate_ids_are_replaced(tmp_path):
+    input_file = write_jsonl(tmp_path / 'in.jsonl', [{'custom_id': str(i)} for i in range(3)])
+    output_file = write_jsonl(tmp_path / 'out.jsonl', [{'custom_id': i, 'answer': 'old'} for i in ['0', '1', '2']])
+    spliced = splice_results(output_file, {'1': {'custom_id': '1', 'answer': 'new'}}, input_file)
+    assert spliced == 1
+    assert read_ids(output_file) == ['0', '1', '2']
+    assert read_rows(output_file)['1']['answer'] == 'new'
+
+
+def test_out_of_order_lines_are_kept_at_the_end(tmp_path):
+    input_file = write_jsonl(tmp_path / 'in.jsonl', [{'custom_id': str(i)} for i in range(4)])
+    #'3' and '1' were appended by --resume; the retried '1' replaces the stale copy
+    output_file = write_jsonl(tmp_path / 'out.jsonl', [{'custom_id': i, 'answer': 'old'} for i in ['0', '3', '1']])
+    spliced = splice_results(output_file, {'1': {'custom_id': '1', 'answer': 'new'}, '2': {'custom_id': '2'}}, input_file)
+    assert spliced == 2
+    assert read_ids(output_file) == ['0', '1', '2', '3']
+    assert read_rows(output_file)['1']['answer'] == 'new'
+
+
+def test_results_without_input_position_are_appended(tmp_path):
+    input_file = write_jsonl(tmp_path / 'in.jsonl', [{'custom_id': '0'}])
+    output_file = write_jsonl(tmp_path / 'out.jsonl', [{'custom_id': '0'}])
+    assert splice_results(output_file, {'x': {'custom_id': 'x'}}, input_file) == 1
+    assert read_ids(output_file) == ['0', 'x']
+
+
+def test_completion_order_appends_and_replaces(tmp_path):
+    output_file = write_jsonl(tmp_path / 'out.jsonl', [{'custom_id': i, 'answer': 'old'} for i in ['2', '0']])
+    spliced = splice_results(output_file, {'0': {'custom_id': '0', 'answer': 'new'}, '1': {'custom_id': '1'}})
+    assert spliced == 2
+    assert read_ids(output_file) == ['2', '0', '1']
+    assert read_rows(output_file)['0']['answer'] == 'new'
+
+
+def test_missing_output_file_is_created(tmp_path):
+    input_file = write_jsonl(tmp_path / 'in.jsonl', [{'custom_id': str(i)} for i in range(2)])
+    output_file = str(tmp_path / 'out.jsonl')
+    assert splice_results(output_file, {'1': {'custom_id': '1'}, '0': {'custom_id': '0'}}, input_file) == 2
+    assert read_ids(output_file) == ['0', '1']
+    assert not (tmp_path / 'out.jsonl.tmp').exists()